@@ -24,7 +24,7 @@ from flask import current_app, request, json, url_for
 from settings import T, lazy_gettext, logging
 import apis
 
-from tools import memcache
+from tools import cache, generations, negative_cache
 
 # Messages
 MSG_NO_USER = T("can not find user %(id)s")
@@ -124,22 +124,22 @@ SITEMAP_CACHE_KEY = "SITEMAP_PAGES"
 SITEMAP_CACHE_TIME = 3600*24*7   # cache 1 week
 
 
-def get_sitemap():
-    sitemap = memcache.get(SITEMAP_CACHE_KEY)
-    if sitemap is None:
-        sitemap = []
-        for post in apis.Post.latest_posts(count=1000):
-            sitemap.append({
-                "loc": url_for("post", postid=post.id, _external=True),
-                "lastmod": post.updated_date.strftime(JSON_DATETIME_FORMAT[0])
-            })
-
-        if sitemap:
-            memcache.set(SITEMAP_CACHE_KEY, sitemap, SITEMAP_CACHE_TIME)
-
+def _fill_sitemap():
+    sitemap = []
+    for post in apis.Post.latest_posts(count=1000):
+        sitemap.append({
+            "loc": url_for("post", postid=post.id, _external=True),
+            "lastmod": post.updated_date.strftime(JSON_DATETIME_FORMAT[0])
+        })
     return sitemap
 
 
+def get_sitemap():
+    key = generations.fold(SITEMAP_CACHE_KEY, "posts")
+    return cache.get_or_fill(key, _fill_sitemap, SITEMAP_CACHE_TIME,
+                             stale_key=SITEMAP_CACHE_KEY, cache_empty=False)
+
+
 @apis.User.requires_site_owner
 def create_user(**settings):
     """create a new user.
@@ -243,17 +243,6 @@ CATEGORY_CACHE_PAGES = 5  # cache first pages only
 CATEGORY_CACHE_KEY = "category_id:%s_posts_page:%s_count:%s_public:%s"
 
 
-def _delete_category_posts_cache(category):
-    default_category = apis.Category.default_category()
-    for page in range(CATEGORY_CACHE_PAGES+1):
-        for public in (True, False):
-            key = CATEGORY_CACHE_KEY % (category.id, page, category.posts_per_page, public)
-            memcache.delete(key)
-            if category.id != default_category.id:
-                key = CATEGORY_CACHE_KEY % (default_category.id, page, default_category.posts_per_page, public)
-                memcache.delete(key)
-
-
 def get_posts_by_category(category="", page=1, per_page=10, group_by="", start_cursor=""):
     """get all posts of a category.
     Args:
@@ -290,15 +279,14 @@ def get_posts_by_category(category="", page=1, per_page=10, group_by="", start_c
     }
 
     if page <= CATEGORY_CACHE_PAGES:  # cache only CATEGORY_CACHE_PAGES pages
-        key = CATEGORY_CACHE_KEY % (category.id, page, per_page, get_no_published)
-        res = memcache.get(key)
+        base_key = CATEGORY_CACHE_KEY % (category.id, page, per_page, get_no_published)
+        key = generations.fold(base_key, "category:%s" % category.id, "posts")
 
-        if res is None:
+        def fill():
             posts, end_cursor = category.get_posts(page, per_page, get_no_published, start_cursor)
-            posts = [post.to_dict() for post in posts]
-            memcache.set(key, (posts, end_cursor))
-        else:
-            posts, end_cursor = res
+            return _posts_to_dicts(posts), end_cursor
+
+        posts, end_cursor = cache.get_or_fill(key, fill, stale_key=base_key if page == 1 else None)
     else:
         posts, end_cursor = category.get_posts(page, per_page, get_no_published, start_cursor)
 
@@ -321,7 +309,6 @@ def create_category(**settings):
 
 
     category = apis.Category.create_category(**settings)
-    _delete_category_posts_cache(category)
 
     result = {
         "category": category
@@ -342,7 +329,6 @@ def update_category(id, **settings):
     if not category:
         raise Exception(lazy_gettext(MSG_NO_CATEGORY, id=id))
 
-    _delete_category_posts_cache(category)
     category.update(**settings)
 
     result = {
@@ -366,8 +352,6 @@ def delete_category(id):
     if category.url == "":
         raise Exception(lazy_gettext("can not delete Home category"))
 
-    _delete_category_posts_cache(category)
-
     result = {
         "category": category.to_dict(),
     }
@@ -388,15 +372,10 @@ def create_post(category_id=None, **settings):
     if not category:
         category = apis.Category.default_category()
 
-    _delete_category_posts_cache(category)
-    memcache.delete(SITEMAP_CACHE_KEY)
-
     author = apis.User.get_current_user()
 
     post = apis.Post.create_post(author, category, **settings)
 
-    _delete_post_cache(post)
-
     result = {
         "post": post
     }
@@ -406,9 +385,25 @@ def create_post(category_id=None, **settings):
 POST_CACHE_KEY = "post_id:%s"
 
 
-def _delete_post_cache(post):
-    key = POST_CACHE_KEY % post.id
-    memcache.delete(key)
+def _post_namespaces(id):
+    # cached posts embed their author and category
+    return ["post:%s" % id, "users", "categories"]
+
+
+def _posts_to_dicts(posts):
+    """ serialize posts, reusing and filling the per-post caches in batch """
+    keys = generations.fold_multi([(POST_CACHE_KEY % post.id, _post_namespaces(post.id))
+                                   for post in posts])
+    cached = cache.get_multi(keys)
+
+    missing = [(key, post) for key, post in zip(keys, posts) if key not in cached]
+    if missing:
+        filled = dict(zip([key for key, _ in missing],
+                          apis.Post.to_dicts([post for _, post in missing])))
+        cache.set_multi(filled)
+        cached.update(filled)
+
+    return [cached[key] for key in keys]
 
 
 @apis.User.requires_site_admin
@@ -424,13 +419,8 @@ def update_post(id, **settings):
     if not post:
         raise Exception(lazy_gettext(MSG_NO_POST, id=id))
 
-    _delete_post_cache(post)
-    _delete_category_posts_cache(post.category)
-
     post.update(**settings)
 
-    _delete_category_posts_cache(post.category)
-
     result = {
         "post": post
     }
@@ -448,9 +438,6 @@ def delete_post(id):
     if not post:
         raise Exception(lazy_gettext(MSG_NO_POST, id=id))
 
-    _delete_post_cache(post)
-    _delete_category_posts_cache(post.category)
-
     result = {
         "post": post.to_dict(),
     }
@@ -467,14 +454,14 @@ def get_post(id):
     Returns:
         post: a dict of post"""
 
-    key = POST_CACHE_KEY % id
+    key = generations.fold(POST_CACHE_KEY % id, *_post_namespaces(id))
 
-    post = memcache.get(key)
+    post = cache.get(key)
     if post is None:
         post = apis.Post.get_by_id(id)
         if post:
             post = post.to_dict()
-            memcache.set(key, post)
+            cache.set(key, post)
 
     if not post:
         raise Exception(lazy_gettext(MSG_NO_POST, id=id))
@@ -489,8 +476,13 @@ def get_post(id):
     }
 
 
-HOT_POSTS_CACHE_KEY = "HOT_POSTS_count:%s_order:%s"
+HOT_POSTS_CACHE_KEY = "hot_posts_count:%s_order:%s"
 HOT_POSTS_CACHE_TIME = 3600*24   # cache 1 day
+HOT_POSTS_SOFT_TIME = 3600   # refresh in background after 1 hour
+
+
+def _fill_hot_posts(count, order):
+    return _posts_to_dicts(apis.Post.hot_posts(count, order))
 
 
 def get_hot_posts(count=8, order="view_count desc"):
@@ -501,20 +493,24 @@ def get_hot_posts(count=8, order="view_count desc"):
     Returns:
         posts: a list of post"""
 
-    key = HOT_POSTS_CACHE_KEY % (count, order)
-    posts = memcache.get(key)
-    if posts is None:
-        posts = apis.Post.hot_posts(count, order)
-        if posts:
-            memcache.set(key, posts, HOT_POSTS_CACHE_TIME)
+    base_key = HOT_POSTS_CACHE_KEY % (count, order)
+    key = generations.fold(base_key, "posts")
+    posts = cache.get_or_fill(key, _fill_hot_posts, HOT_POSTS_CACHE_TIME, l1=False,
+                              stale_key=base_key, cache_empty=False,
+                              soft_time=HOT_POSTS_SOFT_TIME, args=(count, order))
 
     return {
         "posts": posts
     }
 
 
-LATEST_POSTS_CACHE_KEY = "LATEST_POSTS_count:%s_order:%s"
+LATEST_POSTS_CACHE_KEY = "latest_posts_count:%s_order:%s"
 LATEST_POSTS_CACHE_TIME = 3600*24   # cache 1 day
+LATEST_POSTS_SOFT_TIME = 3600   # refresh in background after 1 hour
+
+
+def _fill_latest_posts(count, order):
+    return _posts_to_dicts(apis.Post.latest_posts(count, order))
 
 
 def get_latest_posts(count=12, order="updated_date desc"):
@@ -524,12 +520,11 @@ def get_latest_posts(count=12, order="updated_date desc"):
         order: posts order, default is "updated_date desc"
     Returns:
         posts: a list of post"""
-    key = LATEST_POSTS_CACHE_KEY % (count, order)
-    posts = memcache.get(key)
-    if posts is None:
-        posts = apis.Post.latest_posts(count, order)
-        if posts:
-            memcache.set(key, posts, LATEST_POSTS_CACHE_TIME)
+    base_key = LATEST_POSTS_CACHE_KEY % (count, order)
+    key = generations.fold(base_key, "posts")
+    posts = cache.get_or_fill(key, _fill_latest_posts, LATEST_POSTS_CACHE_TIME, l1=False,
+                              stale_key=base_key, cache_empty=False,
+                              soft_time=LATEST_POSTS_SOFT_TIME, args=(count, order))
 
     return {
         "posts": posts
@@ -539,11 +534,6 @@ def get_latest_posts(count=12, order="updated_date desc"):
 COMMENT_CACHE_KEY = "comments_postid:%s"
 
 
-def _delete_comments_cache(post_id):
-    key = COMMENT_CACHE_KEY % post_id
-    memcache.delete(key)
-
-
 def get_comments_by_post(id):
     """get comments by post.
     Args:
@@ -554,12 +544,12 @@ def get_comments_by_post(id):
     if not post:
         raise Exception(lazy_gettext(MSG_NO_POST, id=id))
 
-    key = COMMENT_CACHE_KEY % id
+    key = generations.fold(COMMENT_CACHE_KEY % id, "comments:%s" % post.id)
 
-    comments = memcache.get(key)
+    comments = cache.get(key)
     if comments is None:
         comments = [comment.to_dict() for comment in post.Comments]
-        memcache.set(key, comments)
+        cache.set(key, comments)
 
     result = {
         "comments": comments
@@ -653,16 +643,29 @@ def get_photo(id):
     }
 
 
+HOT_PHOTOS_CACHE_KEY = "hot_photos_count:%s_order:%s"
+
+
+def _fill_hot_photos(count, order):
+    return [photo.to_dict() for photo in apis.Photo.hot_photos(count, order)]
+
+
 def get_hot_photos(count=12, order="like_count desc"):
     """get hot photos.
     Args:
         count: photos count
-        order: hot order, default is "view_count desc"
+        order: hot order, default is "like_count desc"
     Returns:
         photos: a list of photos"""
 
+    base_key = HOT_PHOTOS_CACHE_KEY % (count, order)
+    key = generations.fold(base_key, "photos")
+    photos = cache.get_or_fill(key, _fill_hot_photos, HOT_POSTS_CACHE_TIME, l1=False,
+                               stale_key=base_key, cache_empty=False,
+                               soft_time=HOT_POSTS_SOFT_TIME, args=(count, order))
+
     return {
-        "photos": apis.Photo.hot_photos(count, order)
+        "photos": photos
     }
 
 
@@ -696,8 +699,6 @@ def create_comment(post_id, author, content, parent_id=-1):
 
     comment = apis.Comment.add_comment(author, content, post_id, parent_id)
 
-    _delete_comments_cache(post_id)
-
     result = {
         "comment": comment
     }
@@ -716,9 +717,7 @@ def update_comment(id, **settings):
     if not comment:
         raise Exception(lazy_gettext(MSG_NO_COMMENT, id=id))
 
-    _delete_comments_cache(comment.post_id)
     comment.update(**settings)
-    _delete_comments_cache(comment.post_id)
 
     result = {
         "comment": comment,
@@ -737,8 +736,6 @@ def delete_comment(id):
     if not comment:
         raise Exception(lazy_gettext(MSG_NO_COMMENT, id=id))
 
-    _delete_comments_cache(comment.post_id)
-
     comment.delete()
 
     result = {
@@ -766,12 +763,13 @@ def get_posts_by_tag(name, page=1, per_page=10):
     if not tag:
         raise Exception(lazy_gettext(MSG_NO_TAG, name=name))
 
-    key = TAG_POSTS_CACHE_KEY % (tag.name, page, per_page)
+    key = generations.fold(TAG_POSTS_CACHE_KEY % (tag.name, page, per_page),
+                           "tag:%s" % tag._norm_name, "posts")
 
-    posts = memcache.get(key)
+    posts = cache.get(key)
     if posts is None:
-        posts = [post.to_dict() for post in tag.get_posts(page, per_page)]
-        memcache.set(key, posts, 3600)  # cache 1 hour
+        posts = _posts_to_dicts(tag.get_posts(page, per_page))
+        cache.set(key, posts, 3600)  # cache 1 hour
 
     result = {
         "tag": tag.to_dict(),
@@ -798,15 +796,15 @@ def get_hot_tags(count=12):
         tags: a list of tags"""
 
 
-    key = HOT_TAGS_CACHE_KEY % count
+    key = generations.fold(HOT_TAGS_CACHE_KEY % count, "tags")
 
-    tags = memcache.get(key)
+    tags = cache.get(key, l1=False)
     if tags is None:
-        tags = apis.Tag.hot_tags(count)
-        memcache.set(key, tags, 3600*24)  # cache 24 hour
+        tags = [tag.to_dict() for tag in apis.Tag.hot_tags(count)]
+        cache.set(key, tags, 3600*24, l1=False)  # cache 24 hour
 
     return {
-        "tags": apis.Tag.hot_tags(count)
+        "tags": tags
     }
 
 
@@ -841,7 +839,7 @@ def admin_memcache(action, params={}):
     Returns:
         result: function result"""
     apis.clean_database_cache()
-    function = getattr(memcache, action)
+    function = getattr(cache, action)
     if callable(function):
         result = function(**params)
     else:
@@ -852,6 +850,33 @@ def admin_memcache(action, params={}):
     }
 
 
+@apis.User.requires_site_owner
+def admin_cache_stats():
+    """ cache statistics.
+    Returns:
+        stats: hit ratios per cache tier and cache fill counters
+        families: hits, misses, fill latency, value size and evictions per key family
+        largest_keys: the largest cached values
+        negative: hits and size of the not-found cache of this process
+        identity_map: entity lookups saved by the request identity maps of this process"""
+    result = cache.get_key_stats()
+    result["stats"] = cache.get_stats()
+    result["negative"] = negative_cache.get_stats()
+    result["identity_map"] = apis.get_database_cache_stats()
+    return result
+
+
+@apis.User.requires_site_owner
+def admin_migrate_entity_groups():
+    """ move GAE entities out of the legacy single entity group, in
+    background batches.
+    Returns:
+        moved: entities moved by the first batch"""
+    return {
+        "moved": apis.migrate_entity_groups(),
+    }
+
+
 # define all methods
 AJAX_METHODS = {
     "methods": get_methods,
@@ -887,6 +912,8 @@ AJAX_METHODS = {
     "stats": stats,
     # Admin functions
     "admin/memcache": admin_memcache,
+    "admin/cache_stats": admin_cache_stats,
+    "admin/migrate_entity_groups": admin_migrate_entity_groups,
 }
 
 ERROR_RES = {"status": "error",
@@ -895,17 +922,44 @@ ERROR_RES = {"status": "error",
              }
 
 
+# generations the responses of read methods depend on, for HTTP validators
+AJAX_NAMESPACES = {
+    "category": lambda p: ["categories"],
+    "category/posts": lambda p: ["categories", "posts"],
+    "post": lambda p: _post_namespaces(p["id"]),
+    "posts/latest": lambda p: ["posts"],
+    "post/comments": lambda p: ["comments:%s" % p["id"]],
+    "tag/posts": lambda p: ["tag:%s" % unicode(p["name"]).strip().lower(), "posts"],
+    "tags/hot": lambda p: ["tags"],
+}
+
+
+def parse_parameters(parameters):
+    parameters = parameters.to_dict()
+    for key in parameters:
+        val = json.loads(parameters[key])
+        if isinstance(val, basestring):
+            val = json_loads(val)
+        parameters[key] = val
+    return parameters
+
+
+def get_action_namespaces(parameters, action):
+    """ return the cache namespaces of a read action, None if it has none """
+    namespaces = AJAX_NAMESPACES.get(action)
+    if namespaces:
+        try:
+            return namespaces(parse_parameters(parameters))
+        except Exception:
+            return None
+
+
 def dispatch_action(parameters, action):
     result = ERROR_RES.copy()
     try:
-        parameters = parameters.to_dict()
         method = AJAX_METHODS.get(action)
         if method:
-            for key in parameters:
-                val = json.loads(parameters[key])
-                if isinstance(val, basestring):
-                    val = json_loads(val)
-                parameters[key] = val
+            parameters = parse_parameters(parameters)
             res = method(**parameters)
             result["status"] = "ok"
             result["response"] = res
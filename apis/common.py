@@ -89,17 +89,95 @@ class DBAdapter(object):
 ## Settings
 ###########################################
 from model import DBSiteSettings
-from model import clean_cache
+from model import clean_cache, identity_map_stats
 
 
 def get_site_settings():
     return DBSiteSettings.get_site_settings()
 
 
+import threading
+from time import time as sys_time
+from tools import generations
+
+
+class _Frozen(object):
+    """ read-only attribute view of a dict """
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % name)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class SiteSnapshot(object):
+    """ Immutable in-process copy of the site settings and categories.
+
+    It is shared by every thread and rebuilt when the "settings" or
+    "categories" generation changes, so the navigation bar and category
+    routing are dictionary lookups.  The GAE category query is eventually
+    consistent and may miss a category written just before the bump, so a
+    snapshot is also rebuilt once it is TTL seconds old.
+    """
+    NAMESPACES = ("settings", "categories")
+    TTL = 10
+
+    current = None
+    _lock = threading.Lock()
+
+    def __init__(self, version):
+        dbsettings = get_site_settings()  # None while the database is initialized
+        self.version = version
+        self.expires = sys_time() + self.TTL
+        self.categories = tuple(_Frozen(dbcategory.to_dict())
+                                for dbcategory in (dbsettings.categories if dbsettings else []))
+        self.category_ids = dict((category.url, category.id) for category in self.categories)
+
+        settings = dbsettings.to_dict() if dbsettings else {}
+        settings.update(categories=self.categories,
+                        UserRoles=DBUser.UserRoles,
+                        Templates=DBCategory.Templates,
+                        Orders=DBCategory.Orders)
+        self.settings = _Frozen(settings)
+
+    @classmethod
+    def get(cls):
+        gens = generations.get_multi(cls.NAMESPACES)
+        version = tuple(gens[ns] for ns in cls.NAMESPACES)
+
+        snapshot = cls.current
+        if snapshot is None or snapshot.version != version or snapshot.expires < sys_time():
+            with cls._lock:
+                snapshot = cls.current
+                if snapshot is None or snapshot.version != version or snapshot.expires < sys_time():
+                    snapshot = cls.current = cls(version)
+        return snapshot
+
+
+def get_site_snapshot():
+    return SiteSnapshot.get()
+
+
 def clean_database_cache():
     clean_cache()
 
 
+def get_database_cache_stats():
+    return identity_map_stats()
+
+
+def migrate_entity_groups():
+    """ start moving GAE entities out of the legacy single entity group """
+    import model
+    migrate = getattr(model, "migrate_entity_groups", None)
+    if migrate is None:
+        raise Exception("only the GAE datastore has entity groups")
+    return migrate()
+
+
 ###########################################
 ## User
 ###########################################
@@ -107,7 +185,7 @@ from functools import wraps
 from flask.ext.login import AnonymousUser
 from flask.ext.login import UserMixin, current_user
 from model import DBUser
-from tools import secret_hash
+from tools import secret_hash, negative_cache
 
 
 class Anonymous(AnonymousUser):
@@ -174,7 +252,6 @@ class User(UserMixin, DBAdapter):
 
         dbuser = DBUser.create(email=email)
         dbuser.save()
-        _ = dbuser.stats  # init stats
         dbuser.password = secret_hash(password, salt=None)
         dbuser.update(**settings)
         return cls(dbuser)
@@ -269,7 +346,6 @@ class Comment(DBAdapter):
         dbcomment = DBComment.create(author=author, content=content,
             post_id=post.id, parent_id=parent_id)
         dbcomment.save()
-        _ = dbcomment.stats  # init stats
 
         post.stats.increase("comment_count")
         post.category.stats.increase("comment_count")
@@ -304,7 +380,6 @@ class Photo(DBAdapter):
         dbphoto.url_thumb = url_thumb
         dbphoto.real_file_thumb = real_file_thumb
         dbphoto.save()
-        _ = dbphoto.stats  # init stats
         photo = cls(dbphoto)
         photo.update(**settings)
         return photo
@@ -373,11 +448,14 @@ class Category(DBAdapter):
 
     @classmethod
     def default_category(cls):
-        category = DBCategory.get_by_url("")
+        category_id = get_site_snapshot().category_ids.get("")
+        if category_id is not None:
+            category = DBCategory.get_by_id(category_id)
+        else:
+            category = DBCategory.get_by_url("")
         if not category:
             category = DBCategory.create(url="", name="Home")
             category.save()
-            _ = category.stats  # init stats
         return cls(category)
 
     @classmethod
@@ -392,7 +470,6 @@ class Category(DBAdapter):
             raise Exception("category %s exist" % url)
         dbcategory = DBCategory.create(url=url, name=name)
         dbcategory.save()
-        _ = dbcategory.stats  # init stats
         dbcategory.update(**settings)
         return cls(dbcategory)
 
@@ -405,9 +482,10 @@ class Category(DBAdapter):
     def get_by_url(cls, category_url):
         if not category_url:
             return cls.default_category()
-        category_url = cls.norm_url(category_url)
-        dbcategory = DBCategory.get_by_url(category_url)
-        return dbcategory and cls(dbcategory)
+        category_id = get_site_snapshot().category_ids.get(cls.norm_url(category_url))
+        if category_id is None:
+            return None
+        return cls.get_by_id(category_id)
 
     @classmethod
     def check_exist(cls, **kwargs):
@@ -440,14 +518,17 @@ class Post(DBAdapter):
 
     @classmethod
     def get_by_id(cls, id):
+        if negative_cache.is_missing("posts", unicode(id)):
+            return None
         dbpost = DBPost.get_by_id(id)
+        if not dbpost:
+            negative_cache.add("posts", unicode(id))
         return dbpost and cls(dbpost)
 
     @classmethod
     def create_post(cls, author, category, **settings):
         dbpost = DBPost.create(author_id=author.db_object.id, category_id=category.db_object.id)
         dbpost.save()
-        _ = dbpost.stats  # init stats
         author.stats.increase("post_count")
         category.stats.increase("post_count")
         post = cls(dbpost)
@@ -458,6 +539,11 @@ class Post(DBAdapter):
     def hot_posts(cls, count=8, order="view_count desc"):
         return [cls(post) for post in DBPost.hot_posts(count, order)]
 
+    @classmethod
+    def to_dicts(cls, posts):
+        """ serialize posts or DBPosts with batched relation lookups """
+        return DBPost.to_dicts([getattr(post, "db_object", post) for post in posts])
+
     @classmethod
     def latest_posts(cls, count=8, order="updated_date desc"):
         return [cls(post) for post in DBPost.latest_posts(count, order)]
@@ -561,8 +647,12 @@ class Post(DBAdapter):
 
     @property
     def safe_html(self):
+        return self.render_safe_html(self.body)
+
+    @staticmethod
+    def render_safe_html(body):
         import markdown
-        return markdown.markdown(self.body, safe_mode=True)
+        return markdown.markdown(body, safe_mode=True)
 
 
 ###########################################
@@ -599,7 +689,12 @@ class Tag(DBAdapter):
 
     @classmethod
     def get_tag_by_name(cls, name):
+        namespace = "tag:%s" % name.strip().lower()
+        if negative_cache.is_missing(namespace, name):
+            return None
         dbtag = DBTag.get_tag_by_name(name)
+        if not dbtag:
+            negative_cache.add(namespace, name)
         return dbtag and cls(dbtag)
 
     def get_posts(self, page=1, per_page=10):
@@ -614,6 +709,8 @@ class Tag(DBAdapter):
 ###########################################
 ## Stats
 ###########################################
+import model
+
 STATS_TYPES = ["Photo", "Post", "Comment"]
 STATS_OPER = ["increase", "decrease"]
 
@@ -631,3 +728,9 @@ class Stats(object):
         func = getattr(stats, oper)
         func(name, delta)
         return stats
+
+    @classmethod
+    def count_views(cls, stats_ids):
+        """increase view_count by stats id, a (model name, id) pair, without loading the viewed items"""
+        for kind, id in stats_ids:
+            getattr(model, kind).count(id, "view_count")
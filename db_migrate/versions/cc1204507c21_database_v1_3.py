@@ -0,0 +1,62 @@
+"""database v1.3
+
+Counters move from db_stats to columns of the entities they count.
+
+The _stats_id columns and the db_stats table are left in place, no longer
+mapped: SQLite can not drop columns, and the foreign keys have no names
+to drop them by on MySQL.
+
+Revision ID: cc1204507c21
+Revises: 24871ecda46d
+Create Date: 2026-10-18 10:12:41.305000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'cc1204507c21'
+down_revision = '24871ecda46d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+COUNTERS = ["view_count", "share_count", "like_count", "unlike_count",
+            "post_count", "photo_count", "comment_count"]
+
+TABLES = {
+    "db_user": "DBUser",
+    "db_category": "DBCategory",
+    "db_post": "DBPost",
+    "db_comment": "DBComment",
+    "db_photo": "DBPhoto",
+    "db_tag": "DBTag",
+}
+
+
+def _counters(table):
+    # tags count their posts in their own post_count column already
+    return [name for name in COUNTERS if not (table == "db_tag" and name == "post_count")]
+
+
+def upgrade():
+    for table in sorted(TABLES):
+        names = _counters(table)
+        for name in names:
+            op.add_column(table, sa.Column(name, sa.Integer(), nullable=True))
+
+        op.execute("UPDATE %s SET %s" % (table, ", ".join(
+            "%(name)s = COALESCE((SELECT db_stats.%(name)s FROM db_stats "
+            "WHERE db_stats.id = %(table)s._stats_id), 0)" % {"name": name, "table": table}
+            for name in names)))
+
+
+def downgrade():
+    for table, target_type in sorted(TABLES.items()):
+        names = _counters(table)
+        op.execute("UPDATE db_stats SET %s WHERE target_type = '%s'" % (", ".join(
+            "%(name)s = COALESCE((SELECT %(table)s.%(name)s FROM %(table)s "
+            "WHERE %(table)s._stats_id = db_stats.id), 0)" % {"name": name, "table": table}
+            for name in names), target_type))
+
+        for name in names:
+            op.drop_column(table, name)
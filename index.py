@@ -23,13 +23,15 @@ from settings import gettext
 from flask import Response
 from flask import request, g
 from flask import redirect, url_for, flash, abort
-from werkzeug.contrib.atom import AtomFeed
 
 import apis
-from tools import unquote
+from tools import unquote, cache, generations
 from ajax import dispatch_action, jsonify, get_sitemap, get_latest_posts
+from ajax import get_action_namespaces
 from utils import render_template, get_locale, flask_render_template
 from utils import login_required, login_user, logout_user
+from utils import page_cache, count_view
+from utils import conditional, make_etag, not_modified, add_validators
 
 import model
 app = model.bind_app(app)  # Bind DataBase Models
@@ -38,6 +40,40 @@ app = model.bind_app(app)  # Bind DataBase Models
 ########################################
 ## Views
 ########################################
+# generations every rendered page depends on: site settings, the nav bar
+# and the current user
+PAGE_NAMESPACES = ("settings", "categories", "users")
+
+
+def _tag_namespace(args):
+    return "tag:%s" % unquote(args["tag_name"]).strip().lower()
+
+
+POST_DATE_CACHE_KEY = "post_date:%s"
+
+
+def _post_updated_date(args):
+    """ the date alone is cached, so that a revalidation never builds the post dict """
+    postid = args["postid"]
+    key = generations.fold(POST_DATE_CACHE_KEY % postid, "post:%s" % postid)
+    updated_date = cache.get(key)
+    if updated_date is None:
+        try:
+            post = apis.Post.get_by_id(postid)
+        except Exception:
+            return None
+        if not post:
+            return None
+        updated_date = post.updated_date
+        cache.set(key, updated_date)
+    return updated_date
+
+
+def _feed_updated_date(args):
+    posts = get_latest_posts(12).get("posts", [])
+    return max(post["updated_date"] for post in posts) if posts else None
+
+
 @app.route('/favicon.ico')
 def favicon():
     return app.send_static_file('favicon.ico')
@@ -48,6 +84,17 @@ def robots():
     return app.send_static_file('robots.txt')
 
 
+@app.route('/_ah/warmup')
+def warmup():
+    # GAE keeps /_ah/ private, elsewhere only the owner may trigger it
+    if RUNTIME_ENV not in ("gae", "gae_dev") and not apis.User.get_current_user().is_owner():
+        abort(403)
+
+    from warmup import warmup_caches
+    report = warmup_caches(request.url_root)
+    return jsonify(report)
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     return render_template('error.html', error=gettext("Page not found")), 404
@@ -60,6 +107,8 @@ def before_request():
 
 @app.route('/')
 @app.route("/<path:category_url>", methods=['GET'])
+@conditional(*PAGE_NAMESPACES)
+@page_cache(*PAGE_NAMESPACES)
 def index(category_url=None):
     try:
         category_url = category_url and unquote(category_url)
@@ -77,11 +126,13 @@ def index(category_url=None):
     except:
         abort(404)
 
-    category.stats.increase("view_count")
+    count_view(category)
     return render_template("index.html", category=category, pager = pager)
 
 
 @app.route('/tags/<tag_name>', methods=['GET'])
+@conditional(_tag_namespace, *PAGE_NAMESPACES)
+@page_cache(_tag_namespace, *PAGE_NAMESPACES)
 def tags(tag_name):
     try:
         tag = apis.Tag.get_tag_by_name(unquote(tag_name))
@@ -95,11 +146,14 @@ def tags(tag_name):
         "cur_page": 0,
         "per_page": 10,
     }
-    tag.stats.increase("view_count")
+    count_view(tag)
     return render_template("tags.html", tag=tag, pager=pager)
 
 
 @app.route('/post/<postid>', methods=['GET'])
+@conditional("post:%(postid)s", "comments:%(postid)s", *PAGE_NAMESPACES,
+             last_modified=_post_updated_date)
+@page_cache("post:%(postid)s", "comments:%(postid)s", *PAGE_NAMESPACES)
 def post(postid):
     try:
         post = apis.Post.get_by_id(postid)
@@ -107,7 +161,7 @@ def post(postid):
         from settings import logging
         logging.exception("post not found")
         abort(404)
-    post.stats.increase("view_count")
+    count_view(post)
     return render_template("post.html", post=post, category=post.category)
 
 
@@ -127,10 +181,22 @@ def share():
 
 @app.route('/json/<path:action>', methods=['GET', 'POST'])
 def json(action):
-    return jsonify(dispatch_action(request.values, action))
+    namespaces = request.method == "GET" and get_action_namespaces(request.values, action)
+    if not namespaces:
+        return jsonify(dispatch_action(request.values, action))
+
+    etag = make_etag(namespaces)
+    response = not_modified(etag)
+    if response is None:
+        result = dispatch_action(request.values, action)
+        response = jsonify(result)
+        if result["status"] == "ok":
+            add_validators(response, etag)
+    return response
 
 
 @app.route("/sitemap.xml")
+@conditional("posts")
 def sitemap():
     return Response(flask_render_template("sitemap.xml", sitemap=get_sitemap()),
         mimetype='text/xml')
@@ -138,7 +204,9 @@ def sitemap():
 
 @app.route("/atom")
 @app.route("/feed")
+@conditional("settings", "posts", last_modified=_feed_updated_date)
 def feed():
+    from werkzeug.contrib.atom import AtomFeed
 
     feed = AtomFeed(title=app.config["SiteTitle"],
         subtitle=app.config["SiteSubTitle"],
@@ -149,13 +217,13 @@ def feed():
     posts = get_latest_posts(12).get("posts", [])
 
     for post in posts:
-        feed.add(title=post.title,
-            content=post.safe_html,
+        feed.add(title=post["title"],
+            content=apis.Post.render_safe_html(post["body"]),
             content_type='html',
-            author=post.author.nickname,
-            url=url_for("post", postid=post.id, _external=True),
-            updated=post.updated_date,
-            published=post.post_date)
+            author=(post["author"] or {}).get("nickname"),
+            url=url_for("post", postid=post["id"], _external=True),
+            updated=post["updated_date"],
+            published=post["post_date"])
 
     return Response(feed.to_string(), mimetype='application/xml')
 
@@ -218,8 +286,9 @@ if RUNTIME_ENV in ("bae",):
     from bae.core.wsgi import WSGIApplication
     application = WSGIApplication(application)
 
-elif RUNTIME_ENV in ("local",):    
-    app.run(host='0.0.0.0',debug=True)
+elif RUNTIME_ENV in ("local",):
+    if __name__ == '__main__':  # importable by tools such as warmup.py
+        app.run(host='0.0.0.0',debug=True)
 
 elif RUNTIME_ENV in ("gae", "gae_dev"):
     application = app
@@ -26,7 +26,6 @@ from common import *
 if RUNTIME_ENV in('local','bae'):
     from user import DBUser
     from post import DBPost,DBCategory,DBComment,DBPhoto
-    from stats import DBStats
     from tag import DBTag
 
 
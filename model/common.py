@@ -21,3 +21,307 @@ Orders = ["asc", "desc"]
 
 Welcome_Title = "Welcome to %s"
 Welcome_Post = "Welcome to %s   \n\nPowered by [`ME@deepgully`](http://github.com/deepgully/me/)"
+
+
+########################################
+## Identity Map
+########################################
+import threading
+from time import time as sys_time
+from collections import OrderedDict
+
+from flask.globals import _request_ctx_stack, _app_ctx_stack, current_app
+
+from settings import logging, IDENTITY_MAP_MAX_ITEMS
+
+
+class IdentityMap(object):
+    """ Entities loaded during one request, keyed by identity.
+
+    A map is bound to each request or app context, so concurrent requests
+    never read or clear each other's entities.  The oldest entries are
+    dropped beyond `max_items`; hits and misses add up in `totals`.
+    """
+    totals = {"maps": 0, "hits": 0, "misses": 0, "evictions": 0, "max_size": 0}
+    _totals_lock = threading.Lock()
+
+    def __init__(self, max_items=None):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self.hits = self.misses = self.evictions = self.max_size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def find(self, keys):
+        """ return {key: entity} for the known keys """
+        found = dict((key, self._items[key]) for key in keys if key in self._items)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, entity):
+        self._items.pop(key, None)
+        self._items[key] = entity
+        if self.max_items and len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+            self.evictions += 1
+        self.max_size = max(self.max_size, len(self._items))
+
+    def update(self, entities):
+        for key, entity in entities.iteritems():
+            self.set(key, entity)
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
+    def close(self):
+        """ drop the entities and add the counters to the process totals """
+        self.clear()
+        with self._totals_lock:
+            totals = IdentityMap.totals
+            totals["maps"] += 1
+            totals["hits"] += self.hits
+            totals["misses"] += self.misses
+            totals["evictions"] += self.evictions
+            totals["max_size"] = max(totals["max_size"], self.max_size)
+        self.hits = self.misses = self.evictions = self.max_size = 0
+
+    @classmethod
+    def get_stats(cls):
+        with cls._totals_lock:
+            return dict(cls.totals)
+
+
+def identity_map():
+    """ the identity map of the current request, or app context """
+    ctx = _request_ctx_stack.top or _app_ctx_stack.top
+    if ctx is None:  # no context to share it with
+        return IdentityMap(IDENTITY_MAP_MAX_ITEMS)
+
+    imap = getattr(ctx, "identity_map", None)
+    if imap is None:
+        imap = ctx.identity_map = IdentityMap(IDENTITY_MAP_MAX_ITEMS)
+    return imap
+
+
+def clean_cache(*args, **kwargs):
+    identity_map().clear()
+
+
+def close_identity_map(*args, **kwargs):
+    """ teardown_request callback """
+    identity_map().close()
+
+
+def identity_map_stats():
+    return IdentityMap.get_stats()
+
+
+########################################
+## Bootstrap
+########################################
+class LazyInit(object):
+    """ Database bootstrap run once per process on first use instead of at
+    import, so a new instance can start serving sooner.  It is retried
+    until it succeeds; `elapsed` is the time it took in seconds.
+    """
+
+    def __init__(self, init):
+        self.init = init
+        self.done = False
+        self.elapsed = None
+        self._lock = threading.Lock()
+
+    def __call__(self, app=None):
+        if self.done:
+            return
+        with self._lock:
+            if self.done:
+                return
+            start = sys_time()
+            self.init(app or current_app._get_current_object())
+            self.elapsed = sys_time() - start
+            self.done = True
+        logging.info("database bootstrap took %.3fs" % self.elapsed)
+
+
+########################################
+## Counters
+########################################
+COUNTERS = ("view_count", "share_count", "like_count", "unlike_count",
+            "post_count", "photo_count", "comment_count")
+
+# counters bumped by page views and likes, written in batches
+BUFFERED_COUNTERS = ("view_count", "like_count", "unlike_count", "share_count")
+
+
+def counter_order(order):
+    """ split "like_count desc" into ("like_count", True), for the hot lists """
+    parts = order.split()
+    name = parts[0] if parts else ""
+    direction = parts[1].lower() if len(parts) > 1 else "asc"
+    if name not in COUNTERS or direction not in ("asc", "desc") or len(parts) > 2:
+        raise Exception("order must be a counter in %s, then asc or desc" % (COUNTERS, ))
+    return name, direction == "desc"
+
+
+class Counters(object):
+    """ The `stats` of an entity.  The counters are columns of the entity
+    itself, so reading them needs no second lookup.
+
+    `id` names the entity for Stats.count_views.
+    """
+
+    def __init__(self, owner):
+        self._owner = owner
+
+    @property
+    def id(self):
+        return self._owner.__class__.__name__, self._owner.id
+
+    def __getattr__(self, name):
+        if name not in COUNTERS:
+            raise AttributeError(name)
+        return self._owner.get_counts()[name]
+
+    def to_dict(self):
+        return self._owner.get_counts()
+
+    def increase(self, name, delta=1, commit=True):
+        if name not in COUNTERS:
+            raise Exception("stats name must be in %s" % (COUNTERS, ))
+        self._owner.add_count(name, delta, commit)
+
+    def decrease(self, name, delta=1, commit=True):
+        self.increase(name, -delta, commit)
+
+
+########################################
+## Counter buffer
+########################################
+class CounterBuffer(object):
+    """ Counter deltas aggregated in process per (id, field) and handed to
+    `write` as {id: {field: delta}} in one batch, once `max_items` ids are
+    pending or `interval` seconds passed since the last write.
+
+    Deltas not written yet are lost if the process dies.
+    """
+
+    def __init__(self, write, max_items, interval):
+        self.write = write
+        self.max_items = max_items
+        self.interval = interval
+        self.last_flush = sys_time()
+        self._deltas = {}
+        self._writing = {}  # batch being written, still counted by pending()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.totals = {"added": 0, "flushes": 0, "rows": 0, "errors": 0}
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, id, field, delta=1):
+        with self._lock:
+            counts = self._deltas.setdefault(id, {})
+            counts[field] = counts.get(field, 0) + delta
+            self.totals["added"] += 1
+
+    def pending(self, id):
+        """ {field: delta} of id not written yet """
+        with self._lock:
+            res = dict(self._writing.get(id, {}))
+            for field, delta in self._deltas.get(id, {}).iteritems():
+                res[field] = res.get(field, 0) + delta
+        return res
+
+    def due(self):
+        return bool(self._deltas) and (len(self._deltas) >= self.max_items or
+                                       sys_time() - self.last_flush >= self.interval)
+
+    def flush(self, force=False):
+        """ write the pending deltas if due, return the number of ids written """
+        if not (force or self.due()):
+            return 0
+        if not self._flush_lock.acquire(False):  # another thread is writing
+            return 0
+        try:
+            with self._lock:
+                self._writing, self._deltas = self._deltas, {}
+                self.last_flush = sys_time()
+            if not self._writing:
+                return 0
+
+            try:
+                self.write(self._writing)
+            except Exception:
+                logging.exception("counter buffer flush error")
+                with self._lock:  # keep them for the next flush
+                    for id, counts in self._writing.iteritems():
+                        for field, delta in counts.iteritems():
+                            pending = self._deltas.setdefault(id, {})
+                            pending[field] = pending.get(field, 0) + delta
+                    self.totals["errors"] += 1
+                return 0
+
+            with self._lock:
+                written = len(self._writing)
+                self.totals["flushes"] += 1
+                self.totals["rows"] += written
+                return written
+        finally:
+            with self._lock:
+                self._writing = {}
+            self._flush_lock.release()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.totals)
+            stats["pending"] = len(self._deltas)
+        return stats
+
+
+########################################
+## Leaderboards
+########################################
+def rank(cls, name, scores):
+    """ merge {id: value of counter `name`} into the leaderboard of cls """
+    from tools import leaderboards
+
+    leaderboards.update("%s:%s" % (cls.__name__, name), scores)
+
+
+def get_ranked(cls, count, order, query, keep=None):
+    """ the first `count` entities of cls by `order`, read from its
+    leaderboard.  `query(limit)` fetches them from the database, to build a
+    board that is not cached and for ascending or larger lists.  Ranked
+    entities failing `keep` (no longer public...) are skipped. """
+    from tools import leaderboards
+
+    name, desc = counter_order(order)
+    if not desc or count > leaderboards.size:
+        return query(count)
+    if count <= 0:
+        return []
+
+    board = "%s:%s" % (cls.__name__, name)
+    ids = leaderboards.get(board)
+    if ids is None:
+        entities = query(leaderboards.size)
+        leaderboards.set(board, [(entity.id, getattr(entity, name) or 0) for entity in entities])
+        return entities[:count]
+
+    entities = []
+    for start in range(0, len(ids), count):
+        entities.extend(entity for entity in cls.get_by_ids(ids[start:start + count])
+                        if entity is not None and (keep is None or keep(entity)))
+        if len(entities) >= count:
+            break
+    return entities[:count]
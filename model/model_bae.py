@@ -14,19 +14,38 @@
 # limitations under the License.
 
 from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import OperationalError, ProgrammingError
 
 from flask.ext.sqlalchemy import SQLAlchemy
 
+import atexit
+import threading
+import cPickle as pickle
+
+from sqlalchemy import bindparam, case, func, select
+
+from tools import cache, generations
+from settings import STATS_FLUSH_INTERVAL, STATS_BUFFER_MAX_ITEMS
+
 
 db = SQLAlchemy(session_options={"expire_on_commit": False})
 
 import common
+from common import identity_map, clean_cache, close_identity_map, LazyInit
+from common import COUNTERS, BUFFERED_COUNTERS, Counters, CounterBuffer
+
+# init_database is looked up on each call, model_local replaces it
+ensure_database = LazyInit(lambda app: init_database(app))
+
 
 def bind_app(app):
     db.app = app
     db.init_app(app)
-    init_database(app)
-    app.teardown_request(clean_cache)
+    app.before_request(ensure_database)
+    app.teardown_request(close_identity_map)
+    app.teardown_request(flush_stats)
+    app.teardown_request(discard_bumps)
     return app
 
 
@@ -67,35 +86,110 @@ def create_default_settings(app):
     return settings
 
 
-def init_database(app):
+def check_database():
+    """ return the site settings if the schema is up to date, else None """
     try:
         settings = DBSiteSettings.get_site_settings()
+    except (OperationalError, ProgrammingError):  # tables not created yet
+        db.session.rollback()
+        return None
+
+    if settings and settings.inited and settings.version >= DBSiteSettings.VERSION:
+        return settings
+    return None
+
+
+def upgrade_settings():
+    """ mark the settings of an upgraded database with the new VERSION,
+    return None if the database is new """
+    settings = DBSiteSettings.get_site_settings()
+    if settings and settings.inited:
+        settings.version = DBSiteSettings.VERSION
+        settings.save()
+        return settings
+    return None
 
-        if not settings or not settings.inited:
-            raise Exception("Can not get site settings")
 
-        if settings.version < DBSiteSettings.VERSION:
-            raise Exception("Database expired")
-    except:
+def init_database(app):
+    settings = check_database()
+    if settings is None:
         from alembic import command
+        from settings import migrate_config
 
-        command.upgrade(app.config["MIGRATE_CFG"], "head")
-        settings = create_default_settings(app)
+        command.upgrade(migrate_config(), "head")
+        settings = upgrade_settings() or create_default_settings(app)
 
     app.config["SiteTitle"] = settings.title
     app.config["SiteSubTitle"] = settings.subtitle
     app.config["OwnerEmail"] = settings.owner
 
 
-__db_get_cache = {}
+def _norm_key(cls, id):
+    return "%s_%s" % (cls.__name__, id)
 
 
-def clean_cache(*args, **kwargs):
-    __db_get_cache.clear()
+GET_CHUNK_SIZE = 500  # ids per IN query, below the bound parameter limits
 
 
-def _norm_key(cls, id):
-    return "%s_%s" % (cls.__name__, id)
+def _fetch(cls, ids):
+    """ load `ids` with one IN query per chunk, missing rows map to None """
+    ids = list(ids)
+    res = dict((_norm_key(cls, id), None) for id in ids)
+    for i in range(0, len(ids), GET_CHUNK_SIZE):
+        for db_object in cls.query.filter(cls.id.in_(ids[i:i + GET_CHUNK_SIZE])):
+            res[_norm_key(cls, db_object.id)] = db_object
+    return res
+
+
+ENTITY_CACHE_KEY = "entity:%s"
+ENTITY_CACHE_TIME = 3600 * 24
+
+_uncommitted = threading.local()
+
+
+def _pop_bumps():
+    bumps = getattr(_uncommitted, "bumps", None) or set()
+    _uncommitted.bumps = set()
+    return bumps
+
+
+def bump_after_commit(namespaces, committed=True):
+    """ bump `namespaces` now if the write is committed, else when the
+    session is, so that no reader caches the old rows under the new stamps """
+    if committed:
+        generations.bump(*namespaces)
+    else:
+        if getattr(_uncommitted, "bumps", None) is None:
+            _uncommitted.bumps = set()
+        _uncommitted.bumps.update(namespaces)
+
+
+def discard_bumps(*args, **kwargs):
+    """ teardown_request callback, the session of the request is rolled back """
+    _pop_bumps()
+
+
+def _load_shared(keys):
+    """ look up objects of shared_cache classes in the cross-request cache.
+
+    Entries are folded with a version stamp bumped by save() and delete(),
+    and hold pickles, so every request unpickles its own copy.
+    Returns ({key: object} found, {key: cache key}).
+    """
+    keys = list(keys)
+    cache_keys = dict(zip(keys, generations.fold_multi(
+        [(ENTITY_CACHE_KEY % key, [ENTITY_CACHE_KEY % key]) for key in keys])))
+    cached = cache.get_multi(cache_keys.values())
+    found = dict((key, pickle.loads(cached[cache_key]))
+                 for key, cache_key in cache_keys.iteritems() if cache_key in cached)
+    return found, cache_keys
+
+
+def _store_shared(objects, cache_keys):
+    mapping = dict((cache_keys[key], pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+                   for key, obj in objects.iteritems() if obj is not None)
+    if mapping:
+        cache.set_multi(mapping, ENTITY_CACHE_TIME)
 
 
 def _get(cls, ids):
@@ -103,18 +197,36 @@ def _get(cls, ids):
     if not multiple:
         ids = [ids]
 
+    imap = identity_map()
+    keys = dict((id, _norm_key(cls, id)) for id in ids if id is not None)
+    objects = imap.find(set(keys.itervalues()))
+
+    missing = dict((id, key) for id, key in keys.iteritems() if key not in objects)
+    fetched = {}
+    if missing and cls.shared_cache:
+        # fold before reading the database, so a concurrent write wins
+        fetched, cache_keys = _load_shared(set(missing.itervalues()))
+        missing = dict((id, key) for id, key in missing.iteritems() if key not in fetched)
+
+    if len(missing) == 1:
+        id, key = missing.popitem()
+        loaded = {key: cls.query.get(id)}
+    else:
+        loaded = _fetch(cls, missing.keys()) if missing else {}
+    if loaded and cls.shared_cache:
+        _store_shared(loaded, cache_keys)
+
+    fetched.update(loaded)
+    imap.update(fetched)
+    objects.update(fetched)
+
     results = []
     for id in ids:
         if id is None:
             results.append(None)
             continue
-        key = _norm_key(cls, id)
-
-        if key not in __db_get_cache:
-            db_object = cls.query.get(id)
-            __db_get_cache[key] = db_object
-        else:
-            db_object = __db_get_cache[key]
+        key = keys[id]
+        db_object = objects[key]
 
         if (db_object is not None) and (db_object not in db.session):
             session = object_session(db_object)
@@ -124,7 +236,7 @@ def _get(cls, ids):
                 db.session.add(db_object)
             except:
                 db_object = db.session.merge(db_object)
-                __db_get_cache[key] = db_object
+                imap.set(key, db_object)
 
         results.append(db_object)
 
@@ -134,13 +246,19 @@ def _get(cls, ids):
         return results[0]
 
 
+def _prefetch(cls, ids):
+    """ load distinct `ids` in batch and return the objects found """
+    ids = list(set(id for id in ids if id is not None))
+    return [obj for obj in _get(cls, ids) if obj is not None]
+
+
 def _remove(cls, ids):
     multiple = isinstance(ids, (list, tuple, set))
     if not multiple:
         ids = [ids]
 
-    keys = [_norm_key(cls, id) for id in ids]
-    results = [__db_get_cache.pop(k, None) for k in keys]
+    imap = identity_map()
+    results = [imap.pop(_norm_key(cls, id)) for id in ids]
 
     if multiple:
         return results
@@ -153,11 +271,12 @@ def _update(cls, objs):
     if not multiple:
         objs = [objs]
 
+    imap = identity_map()
     keys = []
     for obj in objs:
         if hasattr(obj, "id"):
             key = _norm_key(cls, obj.id)
-            __db_get_cache[key] = obj
+            imap.set(key, obj)
             keys.append(key)
         else:
             keys.append(None)
@@ -172,6 +291,8 @@ class ModelMixin(object):
     # list
     protect_attrs = []
 
+    shared_cache = False  # cache rows across requests, for rarely written tables
+
     @classmethod
     def get_by_id(cls, id):
         return _get(cls, id)
@@ -180,6 +301,11 @@ class ModelMixin(object):
     def get_by_ids(cls, ids):
         return _get(cls, ids)
 
+    @classmethod
+    def prefetch(cls, ids):
+        """ batch load objects that are about to be read one by one """
+        return _prefetch(cls, ids)
+
     @classmethod
     def get_all(cls, order=None):
         query = cls.query
@@ -200,12 +326,22 @@ class ModelMixin(object):
         obj = cls(*args, **kwargs)
         return obj
 
+    def cache_namespaces(self):
+        """ cache generations invalidated by writing this object """
+        return []
+
+    def _bumped_namespaces(self):
+        namespaces = self.cache_namespaces()
+        if self.shared_cache:
+            namespaces.append(ENTITY_CACHE_KEY % _norm_key(self.__class__, self.id))
+        return namespaces
+
     def to_dict(self):
         _res = {}
         if hasattr(self, "stats"):
             _res["stats"] = self.stats.to_dict()
         res = dict([(k, getattr(self, k)) for k in self.__dict__.keys() if
-                    (not k.startswith("_") and k not in self.protect_attrs)])
+                    (not k.startswith("_") and k not in self.protect_attrs and k not in COUNTERS)])
         res.update(_res)
         return res
 
@@ -215,21 +351,15 @@ class ModelMixin(object):
             self.commit()
 
         _update(self.__class__, self)
+        bump_after_commit(self._bumped_namespaces(), commit)
 
     def delete(self, commit=True):
-        if hasattr(self, "stats"):
-
-            from stats import DBStats
-
-            dbstats = DBStats.get_by_id(self._stats_id)
-            _remove(DBStats, self._stats_id)
-            if dbstats:
-                db.session.delete(dbstats)
-
+        namespaces = self._bumped_namespaces()
         _remove(self.__class__, self.id)
         db.session.delete(self)
         if commit:
             self.commit()
+        bump_after_commit(namespaces, commit)
         return self
 
     def commit(self):
@@ -242,9 +372,6 @@ class ModelMixin(object):
                 if (not attr.startswith("_")) and (attr != "id") and (attr in self.__dict__):
                     need_save = True
                     setattr(self, attr, val)
-                    if attr == "public" and hasattr(self, "stats"):
-                        self.stats.public = val
-                        self.stats.save()
 
         if need_save:
             self.save(commit)
@@ -255,33 +382,128 @@ class ModelMixin(object):
             db.session.commit()
         except:
             db.session.rollback()
+            _pop_bumps()
             raise
+        generations.bump(*_pop_bumps())
 
 
 class StatsMixin(object):
+    """ counters stored as columns of the entity.  View and like counts
+    are buffered in counter_buffer and written by flush_stats """
+    view_count = db.Column(db.Integer, default=0)
+    share_count = db.Column(db.Integer, default=0)
+    like_count = db.Column(db.Integer, default=0)
+    unlike_count = db.Column(db.Integer, default=0)
+
+    post_count = db.Column(db.Integer, default=0)
+    photo_count = db.Column(db.Integer, default=0)
+    comment_count = db.Column(db.Integer, default=0)
+
     @property
     def stats(self):
+        return Counters(self)
+
+    def get_counts(self):
+        counts = dict((name, getattr(self, name) or 0) for name in COUNTERS)
+        for name, delta in counter_buffer.pending((self.__class__, self.id)).iteritems():
+            counts[name] = max(counts[name] + delta, 0)
+        return counts
+
+    def add_count(self, name, delta=1, commit=True):
+        """ other counters are written with an UPDATE of their column in the
+        session, which only invalidates the cached copy of the entity """
+        if name in BUFFERED_COUNTERS:
+            counter_buffer.add((self.__class__, self.id), name, delta)
+            return
+
+        table = self.__table__
+        value = func.coalesce(table.c[name], 0) + delta
+        db.session.execute(table.update().where(table.c.id == self.id)
+                           .values({name: case([(value < 0, 0)], else_=value)}))
+        column = select([table.c[name]]).where(table.c.id == self.id)
+        set_committed_value(self, name, db.session.execute(column).scalar())
+        if commit:
+            self.commit()
+
+        if self.shared_cache:
+            bump_after_commit([ENTITY_CACHE_KEY % _norm_key(self.__class__, self.id)], commit)
+        self.rank(name)
 
-        from stats import DBStats
+    def rank(self, name):
+        """ move the entity in the leaderboard of a counter it changed """
+        common.rank(self.__class__, name, {self.id: getattr(self, name) or 0})
 
-        dbstats = DBStats.get_by_id(self._stats_id)
-        if not dbstats:
-            dbstats = DBStats.create()
-            dbstats.target_type = self.__class__.__name__
-            dbstats.target_id = self.id
-            if hasattr(self, "public"):
-                dbstats.public = self.public
-            dbstats.save()
-            self._stats_id = dbstats.id
-            self.save()
-        return dbstats
+    @classmethod
+    def count(cls, id, name, delta=1):
+        """ add delta to a counter, without loading the entity if it is buffered """
+        if name in BUFFERED_COUNTERS:
+            counter_buffer.add((cls, int(id)), name, delta)
+            return
+
+        obj = cls.get_by_id(id)
+        if obj:
+            obj.add_count(name, delta)
+
+    @classmethod
+    def counter_order(cls, order):
+        name, desc = common.counter_order(order)
+        column = getattr(cls, name)
+        return column.desc() if desc else column.asc()
+
+
+def _write_counts(deltas):
+    """ add {(model class, id): {counter: delta}} to the counter columns with
+    one executemany per table, as `view_count = view_count + :delta`, so
+    concurrent writers add up.  The new values are read back for the
+    leaderboards. """
+    tables = {}
+    for (cls, id), counts in deltas.iteritems():
+        tables.setdefault(cls, {})[id] = counts
+
+    for cls, rows in tables.iteritems():
+        table = cls.__table__
+        names = sorted(set(name for counts in rows.itervalues() for name in counts))
+
+        values = {}
+        for name in names:
+            value = func.coalesce(table.c[name], 0) + bindparam("d_" + name)
+            values[name] = case([(value < 0, 0)], else_=value)
+
+        statement = table.update().where(table.c.id == bindparam("row_id")).values(**values)
+        params = []
+        for id, counts in rows.iteritems():
+            param = dict(("d_" + name, counts.get(name, 0)) for name in names)
+            param["row_id"] = id
+            params.append(param)
+        db.engine.execute(statement, params)
+
+        columns = [table.c.id] + [table.c[name] for name in names]
+        updated = db.engine.execute(select(columns).where(table.c.id.in_(rows.keys()))).fetchall()
+        for name in names:
+            common.rank(cls, name, dict((row["id"], row[name] or 0) for row in updated))
+
+        if cls.shared_cache:
+            generations.bump(*[ENTITY_CACHE_KEY % _norm_key(cls, id) for id in rows])
+
+
+counter_buffer = CounterBuffer(_write_counts, STATS_BUFFER_MAX_ITEMS, STATS_FLUSH_INTERVAL)
+
+
+def flush_stats(*args, **kwargs):
+    """ teardown_request callback, write the buffered counts when due """
+    return counter_buffer.flush(kwargs.get("force", False))
+
+
+atexit.register(flush_stats, force=True)
 
 
 ########################################
 ## Data Models
 ########################################
 class DBSiteSettings(db.Model, ModelMixin):
-    VERSION = 1.2  # update this if tables changed
+    VERSION = 1.3  # update this if tables changed
+
+    shared_cache = True
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -327,3 +549,6 @@ class DBSiteSettings(db.Model, ModelMixin):
     def get_site_settings(cls):
         return cls.get_by_id(1)
 
+    def cache_namespaces(self):
+        return ["settings"]
+
@@ -14,16 +14,23 @@
 # limitations under the License.
 
 import hashlib
+import random
 
 from google.appengine.ext import db
 from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 
 import common
+from common import identity_map, clean_cache, close_identity_map, LazyInit
+from common import COUNTERS, BUFFERED_COUNTERS, Counters
+from tools import cache, generations, run_in_background
+from settings import STATS_FLUSH_INTERVAL, STATS_SHARDS, STATS_ROLLUP_INTERVAL
 
 
 def bind_app(app):
-    init_database(app)
-    app.teardown_request(clean_cache)
+    app.before_request(ensure_database)
+    app.teardown_request(close_identity_map)
     return app
 
 
@@ -56,14 +63,33 @@ def init_database(app):
     if settings is None:
         settings = create_default_settings(app)
     if settings.version < DBSiteSettings.VERSION:
-        settings.version = DBSiteSettings.VERSION
-        settings.save()
+        settings = upgrade_database(settings.key())
 
     app.config["SiteTitle"] = settings.title
     app.config["SiteSubTitle"] = settings.subtitle
     app.config["OwnerEmail"] = settings.owner
 
 
+ensure_database = LazyInit(init_database)
+
+
+def upgrade_database(key):
+    """ raise the version of the settings and start the migrations it
+    needs in one transaction, so that only one of the instances starting
+    with the old version starts them """
+    def txn():
+        settings = db.get(key)
+        if settings.version < DBSiteSettings.VERSION:
+            if settings.version < 1.3:
+                # counters moved from DBStats to their entities
+                run_in_background(migrate_stats, _transactional=True)
+            settings.version = DBSiteSettings.VERSION
+            settings.put()
+        return settings
+
+    return db.run_in_transaction(txn)
+
+
 def gae_order(str_order):
     parts = str_order.split(" ", 2)
     if len(parts) == 1:
@@ -101,36 +127,103 @@ def gae_type_convert(val, target_type):
 
     return val
 
-# DataStore Cache in Memory
-__db_get_cache = {}
+# Cross-request cache of the kinds with shared_cache
+ENTITY_CACHE_KEY = "entity:%s"
+ENTITY_CACHE_TIME = 3600 * 24
+
+
+def _is_shared(key):
+    return getattr(db.class_for_kind(key.kind()), "shared_cache", False)
+
+
+def _entity_cache_key(key):
+    """ entities not migrated yet are cached under their root key too """
+    return ENTITY_CACHE_KEY % _root_key(key)
+
 
+def _load_shared(keys):
+    """ look up entities in the cross-request cache.
 
-def clean_cache(*args, **kwargs):
-    __db_get_cache.clear()
+    Entries are folded with a version stamp bumped by put() and delete(),
+    and hold protobufs, so every request decodes its own copy.
+    Returns ({key: entity} found, {key: cache key}).
+    """
+    if not keys:
+        return {}, {}
+    cache_keys = dict(zip(keys, generations.fold_multi(
+        [(_entity_cache_key(key), [_entity_cache_key(key)]) for key in keys])))
+    cached = cache.get_multi(cache_keys.values())
+    found = dict((key, db.model_from_protobuf(entity_pb.EntityProto(cached[cache_key])))
+                 for key, cache_key in cache_keys.iteritems() if cache_key in cached)
+    return found, cache_keys
 
 
+def _store_shared(entities, cache_keys):
+    # encode the entity as loaded, model_to_protobuf would refresh auto_now dates
+    mapping = dict((cache_keys[key], entity._entity.ToPb().Encode())
+                   for key, entity in entities.iteritems() if key in cache_keys)
+    if mapping:
+        cache.set_multi(mapping, ENTITY_CACHE_TIME)
+
+
+# DataStore Cache in Memory, one identity map per request
 def get(keys, **kwargs):
     keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
-    ret = db.get([key for key in keys if key not in __db_get_cache], **kwargs)
-    if (len(ret) == 1) and (ret[0] is None) and (not multiple):
-        return
-    __db_get_cache.update(dict([(x.key(), x) for x in ret if x is not None]))
-    ret = [__db_get_cache.get(k, None) for k in keys]
+    imap = identity_map()
+    found = imap.find(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        # fold before reading the datastore, so a concurrent write wins
+        fetched, cache_keys = _load_shared([key for key in missing if _is_shared(key)])
+        missing = [key for key in missing if key not in fetched]
+        if missing:
+            # entities not migrated yet are read in the same call, the root key wins
+            legacy = _legacy_keys(missing) if LEGACY_PARENT_READS else {}
+            loaded = {}
+            for entity in db.get(missing + legacy.keys(), **kwargs):
+                if entity is not None:
+                    loaded.setdefault(legacy.get(entity.key(), entity.key()), entity)
+            _store_shared(loaded, cache_keys)
+            fetched.update(loaded)
+        imap.update(fetched)
+        found.update(fetched)
+    ret = [found.get(k, None) for k in keys]
     if multiple:
         return ret
     if len(ret) > 0:
         return ret[0]
 
 
+def _legacy_key(key):
+    return db.Key.from_path(key.kind(), key.id_or_name(), parent=LEGACY_PARENT)
+
+
+def _legacy_keys(keys):
+    """ {legacy key: root key} for the root keys """
+    return dict((_legacy_key(key), key) for key in keys if key.parent() is None)
+
+
+def _root_key(key):
+    if key.parent() == LEGACY_PARENT:
+        return db.Key.from_path(key.kind(), key.id_or_name())
+    return key
+
+
 def remove(keys):
     keys, _ = datastore.NormalizeAndTypeCheckKeys(keys)
-    return [__db_get_cache.pop(k) for k in keys if k in __db_get_cache]
+    imap = identity_map()
+    return [imap.pop(k) for k in keys if k in imap]
 
 
 class DBParent(db.Model):
     pass
 
-BASEMODEL_PARENT = DBParent.get_or_insert("DBParent_basemodel_parent")
+# Entities used to be created under this ancestor, which made the whole site
+# a single entity group limited to about one write per second.  They are now
+# root entities, each its own group; migrate_entity_groups moves old ones.
+LEGACY_PARENT = db.Key.from_path(DBParent.kind(), "DBParent_basemodel_parent")
+LEGACY_PARENT_READS = True  # look up missing keys under LEGACY_PARENT too, until migrated
+BASEMODEL_PARENT = None
 
 
 class BaseModel(db.Model):
@@ -138,14 +231,15 @@ class BaseModel(db.Model):
     protect_attrs = []
     additional_attrs = []
 
+    shared_cache = False  # cache entities across requests, for rarely written kinds
+
     @classmethod
     def create(cls, **kwargs):
         return BaseModel._create(cls, **kwargs)
 
     @staticmethod
     def _create(cls, **kwargs):
-        parent = BASEMODEL_PARENT
-        return cls(parent, **kwargs)
+        return cls(BASEMODEL_PARENT, **kwargs)
 
     @property
     def str_key(self):
@@ -159,6 +253,16 @@ class BaseModel(db.Model):
     def key_name(self):
         return self.key().name()
 
+    def cache_namespaces(self):
+        """ cache generations invalidated by writing this entity """
+        return []
+
+    def _bumped_namespaces(self):
+        namespaces = self.cache_namespaces()
+        if self.shared_cache:
+            namespaces.append(_entity_cache_key(self.key()))
+        return namespaces
+
     def to_dict(self):
         _res = {}
         if hasattr(self, "stats"):
@@ -167,7 +271,7 @@ class BaseModel(db.Model):
 
         props = self.properties()
         res = dict([(k, getattr(self, k)) for k in props.keys() if
-                    (not k.startswith("_") and k not in self.protect_attrs)])
+                    (not k.startswith("_") and k not in self.protect_attrs and k not in COUNTERS)])
 
         res.update(_res)
         return res
@@ -182,9 +286,6 @@ class BaseModel(db.Model):
                         need_save = True
                         val = gae_type_convert(val, props[attr].data_type)
                         setattr(self, attr, val)
-                        if attr == "public" and hasattr(self, "stats"):
-                            self.stats.public = val
-                            self.stats.save()
 
         if need_save:
             self.save()
@@ -202,6 +303,7 @@ class BaseModel(db.Model):
         else:
             raise db.Timeout()
         remove(self.key())
+        generations.bump(*self._bumped_namespaces())
         return ret
 
     def save(self, commit=True):
@@ -210,9 +312,11 @@ class BaseModel(db.Model):
     def delete(self, commit=False):
         keys = [self.key()]
         if hasattr(self, "stats"):
-            keys.append(self.stats.key())
+            keys.extend(DBStatsShard.keys_for(self.counter_id))
         remove(keys)
-        return db.delete(keys)
+        ret = db.delete(keys)
+        generations.bump(*self._bumped_namespaces())
+        return ret
 
     @classmethod
     def get_by_key_name(cls, key_names, parent=None, **kwargs):
@@ -257,6 +361,14 @@ class BaseModel(db.Model):
 
     get_by_ids = get_by_id
 
+    @classmethod
+    def prefetch(cls, ids, parent=None):
+        """ batch load entities that are about to be read one by one """
+        ids = list(set(id for id in ids if id))
+        if not ids:
+            return []
+        return [obj for obj in cls.get_by_ids(ids, parent) if obj is not None]
+
     @classmethod
     def get_all(cls, order=None):
         query = cls.all()
@@ -280,29 +392,35 @@ class BaseModel(db.Model):
         return res and res[0] or None
 
 
-class StatsMixin(object):
-    db_parent = BASEMODEL_PARENT
+# View and like counts are not written per request: increments go to a
+# memcache counter, flushed by a deferred task into one of STATS_SHARDS
+# shard entities, which are folded into the entity every STATS_ROLLUP_INTERVAL.
+# Counts still in memcache are lost if it evicts them.
+STATS_BUFFER_KEY = "stats_buffer:%s:%s"  # counter id, counter
+STATS_FLUSH_KEY = "stats_flush:%s"
+STATS_FLUSH_LOCK_KEY = "stats_flush_lock:%s"
+STATS_FLUSH_LOCK_TIME = 60  # seconds, outlives a flush that died holding it
+STATS_ROLLUP_KEY = "stats_rollup:%s"
+STATS_COUNTS_KEY = "stats_counts:%s"
+STATS_COUNTS_CACHE_TIME = 60
 
-    @property
-    def stats(self):
-        dbstats = DBStats.get_by_id(self._stats_id)
-        if not dbstats:
-            dbstats = DBStats.create()
-            dbstats.target_type = self.__class__.__name__
-            dbstats.target_id = self.id
-            if hasattr(self, "public"):
-                dbstats.public = self.public
-            dbstats.save()
-            self._stats_id = str(dbstats.id)
-            self.save()
-        return dbstats
 
+class DBStatsShard(db.Model):
+    """ counts flushed but not rolled up yet, keyed "<counter id>:<index>" """
+    view_count = db.IntegerProperty(default=0, indexed=False)
+    like_count = db.IntegerProperty(default=0, indexed=False)
+    unlike_count = db.IntegerProperty(default=0, indexed=False)
+    share_count = db.IntegerProperty(default=0, indexed=False)
+
+    @classmethod
+    def keys_for(cls, counter_id):
+        return [db.Key.from_path(cls.kind(), "%s:%d" % (counter_id, index))
+                for index in range(STATS_SHARDS)]
 
-class DBStats(BaseModel):
-    target_type = db.StringProperty()
-    target_id = db.StringProperty()
-    public = db.BooleanProperty(default=True)
 
+class StatsMixin(db.Model):
+    """ counters stored as properties of the entity.  Counter ids are
+    "<kind>:<id>", which stay valid when entities change entity group """
     view_count = db.IntegerProperty(default=0)
     share_count = db.IntegerProperty(default=0)
     like_count = db.IntegerProperty(default=0)
@@ -312,31 +430,182 @@ class DBStats(BaseModel):
     photo_count = db.IntegerProperty(default=0)
     comment_count = db.IntegerProperty(default=0)
 
-    def increase(self, name, delta=1, commit=True):
-            val = getattr(self, name)
-            val += delta
-            setattr(self, name, val)
-            if commit:
-                self.save()
-
-    def decrease(self, name, delta=1, commit=True):
-        val = getattr(self, name)
-        val -= delta
-        if val < 0:
-            val = 0
-        setattr(self, name, val)
-        if commit:
-            self.save()
+    @property
+    def stats(self):
+        return Counters(self)
 
-    def set(self, name, value, commit=True):
-        setattr(self, name, value)
-        if commit:
-            self.save()
+    @property
+    def counter_id(self):
+        return "%s:%s" % (self.kind(), self.id)
+
+    def get_counts(self):
+        """ counters, including the counts not rolled up yet """
+        if getattr(self, "_counts", None) is None:
+            StatsMixin.load_counts([self])
+        return self._counts
+
+    @staticmethod
+    def load_counts(entities):
+        """ fill the counters of many entities with one memcache call, and
+        one datastore call for those whose shards are not cached """
+        entities = [entity for entity in entities if entity is not None]
+        keys = []
+        for entity in entities:
+            keys.append(STATS_COUNTS_KEY % entity.counter_id)
+            keys.extend(STATS_BUFFER_KEY % (entity.counter_id, name) for name in BUFFERED_COUNTERS)
+        cached = memcache.get_multi(keys)
+
+        missing = [entity for entity in entities if STATS_COUNTS_KEY % entity.counter_id not in cached]
+        if missing:
+            shard_keys = []
+            for entity in missing:
+                shard_keys.extend(DBStatsShard.keys_for(entity.counter_id))
+            shards = db.get(shard_keys)
+
+            flushed = {}
+            for index, entity in enumerate(missing):
+                entity_shards = [shard for shard in shards[index * STATS_SHARDS:(index + 1) * STATS_SHARDS] if shard]
+                counts = dict((name, sum(getattr(shard, name) for shard in entity_shards))
+                              for name in BUFFERED_COUNTERS)
+                flushed[STATS_COUNTS_KEY % entity.counter_id] = counts
+            memcache.set_multi(flushed, time=STATS_COUNTS_CACHE_TIME)
+            cached.update(flushed)
+
+        for entity in entities:
+            counts = dict((name, getattr(entity, name) or 0) for name in COUNTERS)
+            flushed = cached[STATS_COUNTS_KEY % entity.counter_id]
+            for name in BUFFERED_COUNTERS:
+                buffered = int(cached.get(STATS_BUFFER_KEY % (entity.counter_id, name), 0))
+                counts[name] = max(counts[name] + flushed[name] + buffered, 0)
+            entity._counts = counts
+        return entities
+
+    def add_count(self, name, delta=1, commit=True):
+        """ counters are written at once whatever `commit` is, without
+        refreshing the auto_now dates of the entity, and only invalidate
+        its cached copy """
+        self._counts = None
+        if name in BUFFERED_COUNTERS:
+            _buffer_count(self.counter_id, name, delta)
+            return
+
+        values = db.run_in_transaction(_add_counts, self.key(), {name: delta})
+        setattr(self, name, values[name])
+        if self.shared_cache:
+            generations.bump(_entity_cache_key(self.key()))
+        self.rank(name)
+
+    def rank(self, name):
+        """ move the entity in the leaderboard of a counter it changed """
+        common.rank(self.__class__, name, {self.id: getattr(self, name) or 0})
+
+    @classmethod
+    def count(cls, id, name, delta=1):
+        """ add delta to a counter, without loading the entity if it is buffered """
+        if name in BUFFERED_COUNTERS:
+            _buffer_count("%s:%s" % (cls.kind(), id), name, delta)
+            return
+
+        entity = cls.get_by_id(id)
+        if entity:
+            entity.add_count(name, delta)
+
+    @classmethod
+    def counter_order(cls, order):
+        name, desc = common.counter_order(order)
+        return "-" + name if desc else name
+
+
+def _add_counts(key, deltas):
+    """ add deltas to the counters of the raw entity, so that auto_now
+    dates are kept.  Call it in a transaction. """
+    entity = datastore.Get(key)
+    for name, delta in deltas.iteritems():
+        entity[name] = max((entity.get(name) or 0) + delta, 0)
+    datastore.Put(entity)
+    return dict((name, entity[name]) for name in deltas)
+
+
+def _add_to_shard(counter_id, deltas):
+    key = random.choice(DBStatsShard.keys_for(counter_id))
+
+    def txn():
+        shard = db.get(key) or DBStatsShard(key=key)
+        for name, delta in deltas.iteritems():
+            setattr(shard, name, getattr(shard, name) + delta)
+        shard.put()
+
+    db.run_in_transaction(txn)
+    memcache.delete(STATS_COUNTS_KEY % counter_id)
+
+
+def _buffer_count(counter_id, name, delta):
+    # memcache counters can not go below zero, decreases are written through
+    if delta < 0 or memcache.incr(STATS_BUFFER_KEY % (counter_id, name), delta, initial_value=0) is None:
+        _add_to_shard(counter_id, {name: delta})
+    elif memcache.add(STATS_FLUSH_KEY % counter_id, 1, time=STATS_FLUSH_INTERVAL):
+        run_in_background(flush_stats, counter_id, _countdown=STATS_FLUSH_INTERVAL)
+
+
+def flush_stats(counter_id):
+    """ deferred task, move the buffered counts of an entity to a shard.
+    Flushes of an entity hold a lock, so that two of them never write the
+    same buffered counts. """
+    lock_key = STATS_FLUSH_LOCK_KEY % counter_id
+    if not memcache.add(lock_key, 1, time=STATS_FLUSH_LOCK_TIME):
+        # another flush is running, take what it leaves later
+        run_in_background(flush_stats, counter_id, _countdown=STATS_FLUSH_INTERVAL)
+        return
+
+    try:
+        keys = dict((STATS_BUFFER_KEY % (counter_id, name), name) for name in BUFFERED_COUNTERS)
+        buffered = dict((key, int(value)) for key, value in memcache.get_multi(keys.keys()).iteritems()
+                        if int(value))
+        if buffered:
+            _add_to_shard(counter_id, dict((keys[key], value) for key, value in buffered.iteritems()))
+            # subtract what was flushed, increments made meanwhile stay buffered
+            memcache.offset_multi(dict((key, -value) for key, value in buffered.iteritems()))
+    finally:
+        memcache.delete(lock_key)
+
+    if memcache.add(STATS_ROLLUP_KEY % counter_id, 1, time=STATS_ROLLUP_INTERVAL):
+        run_in_background(rollup_stats, counter_id, _countdown=STATS_ROLLUP_INTERVAL)
+
+
+def rollup_stats(counter_id):
+    """ deferred task, fold the shards of an entity into its indexed
+    counters and move it in the leaderboards of the hot lists """
+    kind, id = counter_id.split(":")
+    entity = db.class_for_kind(kind).get_by_id(id)
+    if entity is None:
+        return
+    key = entity.key()
+    shard_keys = DBStatsShard.keys_for(counter_id)
+
+    def txn():
+        shards = [shard for shard in db.get(shard_keys) if shard]
+        if not shards:
+            return None
+        values = _add_counts(key, dict((name, sum(getattr(shard, name) for shard in shards))
+                                       for name in BUFFERED_COUNTERS))
+        db.delete(shards)
+        return values
+
+    values = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    if values:
+        remove(key)
+        memcache.delete(STATS_COUNTS_KEY % counter_id)
+        if entity.shared_cache:
+            generations.bump(_entity_cache_key(key))
+        for name, value in values.iteritems():
+            common.rank(entity.__class__, name, {entity.id: value})
 
 
 # DataStore Models
-class DBSiteSettings(BaseModel, StatsMixin):
-    VERSION = 1.2  # update this if tables changed
+class DBSiteSettings(BaseModel):
+    VERSION = 1.3  # update this if tables changed
+
+    shared_cache = True
 
     version = db.FloatProperty(default=0.0)
     title = db.StringProperty()
@@ -370,12 +639,17 @@ class DBSiteSettings(BaseModel, StatsMixin):
 
     @classmethod
     def create_settings(cls, **kwargs):
-        return cls.get_or_insert("DBSiteSettings/settings", parent=BASEMODEL_PARENT, **kwargs)
+        return cls.get_or_insert("DBSiteSettings/settings", **kwargs)
+
+    def cache_namespaces(self):
+        return ["settings"]
 
 
 class DBUser(BaseModel, StatsMixin):
     UserRoles = common.UserRoles
 
+    shared_cache = True
+
     protect_attrs = ["password", "email"]
 
     email = db.StringProperty(required=True)
@@ -388,8 +662,6 @@ class DBUser(BaseModel, StatsMixin):
 
     joined_date = db.DateTimeProperty(auto_now_add=True)
 
-    _stats_id = db.StringProperty()
-
     @classmethod
     def create(cls, **kwargs):
         if "nickname" not in kwargs:
@@ -407,6 +679,9 @@ class DBUser(BaseModel, StatsMixin):
     def get_user_by_email(cls, email):
         return cls.filter_one(email=email.strip().lower())
 
+    def cache_namespaces(self):
+        return ["posts", "users"]  # authors are embedded in cached posts and pages
+
     def to_dict(self):
         res = BaseModel.to_dict(self)
         res["avatar_url"] = self.avatar_url
@@ -417,6 +692,8 @@ class DBCategory(BaseModel, StatsMixin):
     Templates = common.Templates
     Orders = common.Orders
 
+    shared_cache = True
+
     url = db.StringProperty(default="")
     name = db.StringProperty(required=True)
     sort = db.IntegerProperty(default=0)
@@ -426,8 +703,6 @@ class DBCategory(BaseModel, StatsMixin):
     template = db.StringProperty(choices=Templates, default=Templates[0])
     content = db.TextProperty(default="")  # for template "Text" only
 
-    _stats_id = db.StringProperty()
-
     @property
     def Posts(self):
         return DBPost.all().filter("category_id =", self.id)
@@ -454,6 +729,9 @@ class DBCategory(BaseModel, StatsMixin):
         category_url = category_url.strip().lower()
         return cls.filter_one(url=category_url)
 
+    def cache_namespaces(self):
+        return ["category:%s" % self.id, "categories"]  # categories make up the nav bar
+
 
 class DBPost(BaseModel, StatsMixin):
     additional_attrs = ["tags"]
@@ -469,8 +747,6 @@ class DBPost(BaseModel, StatsMixin):
 
     category_id = db.StringProperty()
     author_id = db.StringProperty()
-
-    _stats_id = db.StringProperty()
     _tag_list = db.ListProperty(str, default=[])
 
     @classmethod
@@ -503,36 +779,61 @@ class DBPost(BaseModel, StatsMixin):
     def tags(self, value):
         self._tag_list = list(set(value))
 
-    def to_dict(self):
+    def to_dict(self, photos=None):
         res = BaseModel.to_dict(self)
         author = self.author
         res["author"] = author.to_dict() if author is not None else ""
         category = self.category
         res["category"] = category.to_dict() if category is not None else ""
-        res["photos"] = [photo.to_dict() for photo in self.photos if photo is not None]
+        if photos is None:
+            photos = self.photos
+        res["photos"] = [photo.to_dict() for photo in photos if photo is not None]
         res["tags"] = self.tags
         return res
 
+    @classmethod
+    def to_dicts(cls, posts):
+        """ serialize a page of posts, loading their authors, categories,
+        photos and counters with one batch per relation """
+        if not posts:
+            return []
+
+        post_ids = [post.id for post in posts]
+        photos = {}
+        for i in range(0, len(post_ids), 30):  # datastore IN filters take 30 values
+            for photo in DBPhoto.all().filter("post_id IN", post_ids[i:i + 30]):
+                photos.setdefault(photo.post_id, []).append(photo)
+
+        items = list(posts)
+        items.extend(DBUser.prefetch([post.author_id for post in posts]))
+        items.extend(DBCategory.prefetch([post.category_id for post in posts]))
+        for post_photos in photos.itervalues():
+            items.extend(post_photos)
+        StatsMixin.load_counts(items)
+
+        return [post.to_dict(photos.get(post.id, [])) for post in posts]
+
     @classmethod
     def hot_posts(cls, count=8, order="view_count desc"):
-        query = DBStats.all().filter("public =", True).filter("target_type =", cls.__name__).order(gae_order(order))
-        ids = [stats.target_id for stats in query.fetch(count)]
-        return [post for post in cls.get_by_ids(ids) if post and post.public]
+        def query(limit):
+            return cls.all().filter("public =", True).order(cls.counter_order(order)).fetch(limit)
+
+        return common.get_ranked(cls, count, order, query, lambda post: post.public)
 
     @classmethod
     def latest_posts(cls, count=8, order="updated_date desc"):
         return cls.all().filter("public =", True).order(gae_order(order)).fetch(count)
 
+    def cache_namespaces(self):
+        return ["posts", "post:%s" % self.id]
+
 
 class DBTag(BaseModel, StatsMixin):
     created_date = db.DateTimeProperty(auto_now_add=True)
     _norm_name = db.StringProperty()
     name = db.StringProperty()
-    post_count = db.IntegerProperty(default=0)
     _post_id_list = db.ListProperty(str, default=[])
 
-    _stats_id = db.StringProperty()
-
     @property
     def post_ids(self):
         return self._post_id_list
@@ -548,6 +849,7 @@ class DBTag(BaseModel, StatsMixin):
             self.post_count += 1
             self._post_id_list.append(post_id)
             self.save()
+            self.rank("post_count")
 
     def remove_post_id(self, post_id):
         post_id = str(post_id)
@@ -555,6 +857,7 @@ class DBTag(BaseModel, StatsMixin):
             self.post_count -= 1
             self._post_id_list.remove(post_id)
             self.save()
+            self.rank("post_count")
 
     def get_posts(self, page=1, per_page=10):
         posts_list = map(long, self._post_id_list)
@@ -564,7 +867,10 @@ class DBTag(BaseModel, StatsMixin):
 
     @classmethod
     def hot_tags(cls, count=16):
-        return DBTag.all().order("-post_count").filter("post_count >", 0).fetch(count)
+        def query(limit):
+            return DBTag.all().order("-post_count").filter("post_count >", 0).fetch(limit)
+
+        return common.get_ranked(DBTag, count, "post_count desc", query, lambda tag: tag.post_count > 0)
 
     @classmethod
     def get_tag_by_name(cls, name):
@@ -574,6 +880,14 @@ class DBTag(BaseModel, StatsMixin):
     def create(cls, name):
         return BaseModel._create(cls, name=name.strip(), _norm_name=name.strip().lower())
 
+    def to_dict(self):
+        res = BaseModel.to_dict(self)
+        res["post_count"] = self.post_count
+        return res
+
+    def cache_namespaces(self):
+        return ["tags", "tag:%s" % self._norm_name]
+
 
 class DBPhoto(BaseModel, StatsMixin):
     created_date = db.DateTimeProperty(auto_now_add=True)
@@ -587,7 +901,6 @@ class DBPhoto(BaseModel, StatsMixin):
     public = db.BooleanProperty(default=True)
 
     post_id = db.StringProperty()
-    _stats_id = db.StringProperty()
 
     @property
     def post(self):
@@ -595,9 +908,13 @@ class DBPhoto(BaseModel, StatsMixin):
 
     @classmethod
     def hot_photos(cls, count=12, order="like_count desc"):
-        query = DBStats.all().filter("public =", True).filter("target_type =", cls.__name__).order(gae_order(order))
-        ids = [stats.target_id for stats in query.fetch(count)]
-        return [photo for photo in cls.get_by_ids(ids) if photo and photo.public]
+        def query(limit):
+            return cls.all().filter("public =", True).order(cls.counter_order(order)).fetch(limit)
+
+        return common.get_ranked(cls, count, order, query, lambda photo: photo.public)
+
+    def cache_namespaces(self):
+        return ["posts", "photos", "post:%s" % self.post_id]
 
 
 class DBComment(BaseModel, StatsMixin):
@@ -608,7 +925,6 @@ class DBComment(BaseModel, StatsMixin):
 
     parent_id = db.StringProperty(default="")
     post_id = db.StringProperty()
-    _stats_id = db.StringProperty()
 
     @classmethod
     def create(cls, author, content, post_id, parent_id="", **kwargs):
@@ -621,6 +937,9 @@ class DBComment(BaseModel, StatsMixin):
     def post(self):
         return DBPost.get_by_id(self.post_id)
 
+    def cache_namespaces(self):
+        return ["comments:%s" % self.post_id]
+
     def to_dict(self):
         res = BaseModel.to_dict(self)
         if self.deleted:
@@ -629,6 +948,156 @@ class DBComment(BaseModel, StatsMixin):
         return res
 
 
+########################################
+## Entity group migration
+########################################
+MIGRATE_KINDS = ["DBSiteSettings", "DBUser", "DBCategory", "DBPost",
+                 "DBTag", "DBPhoto", "DBComment", "DBStats"]
+MIGRATE_BATCH_SIZE = 100
+MIGRATE_TXN_SIZE = 4  # xg transactions span 5 entity groups, the legacy one and a root one per copy
+
+
+def _move_entities(kind, keys):
+    """ copy raw entities to root keys with the same id or name, then
+    delete the originals.  Raw entities keep their auto_now dates.  Each
+    few entities are read and moved in a transaction, an entity whose
+    root key is taken is left in place.  Returns the keys moved. """
+    from settings import logging
+
+    # keep the datastore from allocating the copied ids to new entities
+    ids = [key.id() for key in keys if key.id()]
+    if ids:
+        result = db.allocate_id_range(db.Key.from_path(kind, 1), min(ids), max(ids))
+        if result != db.KEY_RANGE_EMPTY:
+            logging.warning("entity group migration: %s ids %d to %d may be in use (%s)"
+                            % (kind, min(ids), max(ids), result))
+
+    def txn(legacy_keys):
+        root_keys = [_root_key(key) for key in legacy_keys]
+        found = datastore.Get(legacy_keys + root_keys)
+        copies, moved = [], []
+        for entity, root in zip(found[:len(legacy_keys)], found[len(legacy_keys):]):
+            if entity is None:
+                continue
+            key = entity.key()
+            if root is not None:
+                logging.error("entity group migration: %s is kept, %s exists" % (key, root.key()))
+                continue
+            copy = datastore.Entity(kind, name=key.name(), id=key.id(),
+                                    unindexed_properties=entity.unindexed_properties())
+            copy.update(entity)
+            copies.append(copy)
+            moved.append(key)
+        if copies:
+            datastore.Put(copies)
+            datastore.Delete(moved)
+        return moved
+
+    options = db.create_transaction_options(xg=True)
+    moved = []
+    for start in xrange(0, len(keys), MIGRATE_TXN_SIZE):
+        moved.extend(db.run_in_transaction_options(options, txn, keys[start:start + MIGRATE_TXN_SIZE]))
+
+    remove(moved)
+    if moved and db.class_for_kind(kind).shared_cache:
+        # the cached copies are the legacy entities
+        generations.bump(*[_entity_cache_key(key) for key in moved])
+    return moved
+
+
+def migrate_entity_groups(kinds=None, moved=0, last_key=None):
+    """ move the entities under LEGACY_PARENT to root keys, one batch per
+    deferred task.  Set LEGACY_PARENT_READS to False once it has finished.
+    Entities left in place are passed by, `last_key` is the last one read.
+    Returns the number of entities moved by this task and the ones before. """
+    from settings import logging
+    from tools import run_in_background
+
+    kinds = list(MIGRATE_KINDS if kinds is None else kinds)
+    if not kinds:
+        db.delete(LEGACY_PARENT)
+        logging.info("entity group migration done, %d entities moved" % moved)
+        return moved
+
+    kind = kinds[0]
+    query = datastore.Query(kind, keys_only=True)
+    query.Ancestor(LEGACY_PARENT)
+    if last_key is not None:
+        query["__key__ >"] = db.Key(last_key)
+    query.Order("__key__")
+    keys = query.Get(MIGRATE_BATCH_SIZE)
+    if keys:
+        count = len(_move_entities(kind, keys))
+        moved += count
+        last_key = str(keys[-1])
+        logging.info("entity group migration: %d %s moved" % (count, kind))
+    else:
+        kinds.pop(0)
+        last_key = None
+
+    run_in_background(migrate_entity_groups, kinds, moved, last_key)
+    return moved
+
+
+########################################
+## Stats migration
+########################################
+STATS_KINDS = ["DBUser", "DBCategory", "DBPost", "DBTag", "DBPhoto", "DBComment"]
+
+
+def _migrate_entity_stats(key):
+    """ add the counters of the DBStats entity of an entity to it and
+    delete the DBStats entity, in one transaction that reads the entity
+    again, so that it is done once.  Returns False if it was done before. """
+    def txn():
+        entity = datastore.Get([key])[0]
+        if entity is None or not entity.get("_stats_id"):
+            return False
+        stats_key = datastore.Key.from_path("DBStats", long(entity["_stats_id"]))
+        found = datastore.Get([stats_key, _legacy_key(stats_key)])
+        stats = found[0] or found[1]
+        if stats is not None:
+            for name in COUNTERS:
+                if key.kind() == "DBTag" and name == "post_count":
+                    continue  # tags count their posts themselves
+                entity[name] = (entity.get(name) or 0) + (stats.get(name) or 0)
+            datastore.Delete(stats.key())
+        del entity["_stats_id"]
+        datastore.Put(entity)  # raw entity, so that auto_now dates are kept
+        return True
+
+    return db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+
+
+def migrate_stats(kinds=None, moved=0):
+    """ deferred task, add the counters of the DBStats entities that
+    VERSION 1.2 kept apart to their owners, then delete them.  Entities
+    leave the query once their _stats_id is removed, one batch per task.
+    The query may still return entities done before, they are skipped. """
+    from settings import logging
+
+    kinds = list(STATS_KINDS if kinds is None else kinds)
+    if not kinds:
+        logging.info("stats migration done, %d entities updated" % moved)
+        return moved
+
+    kind = kinds[0]
+    keys = datastore.Query(kind, {"_stats_id >": ""}, keys_only=True).Get(MIGRATE_BATCH_SIZE)
+    if not keys:
+        kinds.pop(0)
+        run_in_background(migrate_stats, kinds, moved)
+        return moved
+
+    keys = [key for key in keys if _migrate_entity_stats(key)]
+    remove(keys)
+    if keys and db.class_for_kind(kind).shared_cache:
+        generations.bump(*[_entity_cache_key(key) for key in keys])
+    logging.info("stats migration: %d %s updated" % (len(keys), kind))
+
+    run_in_background(migrate_stats, kinds, moved + len(keys))
+    return moved + len(keys)
+
+
 def main():
     pass
 
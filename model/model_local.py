@@ -22,28 +22,22 @@ from model_bae import *   # use same db model with BAE
 
 
 def init_database(app):
-    try:
-        settings = DBSiteSettings.get_by_id(1)
-
-        if not settings or not settings.inited:
-            raise Exception("Can not get site settings")
-
-        if settings.version < DBSiteSettings.VERSION:
-            raise Exception("Database expired")
-    except:
+    settings = check_database()
+    if settings is None:
         from alembic import command
+        from settings import migrate_config
 
         # auto generate alembic version in local
         try:
-            command.revision(app.config["MIGRATE_CFG"],
+            command.revision(migrate_config(),
                              "database v%s" % DBSiteSettings.VERSION,
                              True)
         except:
             logging.exception("migrate revision error")
 
-        command.upgrade(app.config["MIGRATE_CFG"], "head")
+        command.upgrade(migrate_config(), "head")
 
-        settings = create_default_settings(app)
+        settings = upgrade_settings() or create_default_settings(app)
 
     app.config["SiteTitle"] = settings.title
     app.config["SiteSubTitle"] = settings.subtitle
@@ -2,13 +2,14 @@ from datetime import datetime
 from model_bae import ModelMixin, StatsMixin, db
 # from category import DBCategory
 from user import DBUser
-from stats import DBStats
 import common
 
 
 class DBCategory(db.Model, ModelMixin, StatsMixin):
     __tablename__ = "db_category"
 
+    shared_cache = True
+
     Templates = common.Templates
     Orders = common.Orders
 
@@ -25,8 +26,6 @@ class DBCategory(db.Model, ModelMixin, StatsMixin):
     template = db.Column(db.Enum(*Templates), default=Templates[0])
     content = db.Column(db.Text)  # for template "Text" only
 
-    _stats_id = db.Column(db.Integer, db.ForeignKey(DBStats.__tablename__ + '.id', ondelete="SET NULL"))
-
     def __init__(self, url, name, sort=0, order=Orders[1], template=Templates[0]):
         self.url = url
         self.name = name
@@ -59,6 +58,9 @@ class DBCategory(db.Model, ModelMixin, StatsMixin):
     def get_by_url(cls, category_url):
         return cls.filter_one(url=category_url)
 
+    def cache_namespaces(self):
+        return ["category:%s" % self.id, "categories"]  # categories make up the nav bar
+
 class DBPost(db.Model, ModelMixin, StatsMixin):
     __tablename__ = "db_post"
 
@@ -83,7 +85,6 @@ class DBPost(db.Model, ModelMixin, StatsMixin):
     author_id = db.Column(db.Integer, db.ForeignKey(DBUser.__tablename__ + ".id", ondelete="SET NULL"), index=True)
     _author = db.relationship('DBUser', backref=db.backref('posts', lazy='dynamic'))
 
-    _stats_id = db.Column(db.Integer, db.ForeignKey(DBStats.__tablename__ + '.id', ondelete="SET NULL"))
     _tag_list = db.Column(db.Text, default="")
 
 
@@ -122,24 +123,46 @@ class DBPost(db.Model, ModelMixin, StatsMixin):
     def tags(self, value):
         self._tag_list = ",".join(list(set(value)))
 
-    def to_dict(self):
+    def to_dict(self, photos=None):
         res = ModelMixin.to_dict(self)
         res["author"] = self.author.to_dict() if self.author is not None else {}
         res["category"] = self.category.to_dict() if self.category is not None else {}
-        res["photos"] = [photo.to_dict() for photo in self.photos if photo is not None]
+        if photos is None:
+            photos = self.photos
+        res["photos"] = [photo.to_dict() for photo in photos if photo is not None]
         res["tags"] = self.tags
         return res
 
+    @classmethod
+    def to_dicts(cls, posts):
+        """ serialize a page of posts, loading their authors, categories
+        and photos with one query per relation """
+        if not posts:
+            return []
+
+        photos = {}
+        for photo in DBPhoto.query.filter(DBPhoto.post_id.in_([post.id for post in posts])):
+            photos.setdefault(photo.post_id, []).append(photo)
+
+        DBUser.prefetch([post.author_id for post in posts])
+        DBCategory.prefetch([post.category_id for post in posts])
+
+        return [post.to_dict(photos.get(post.id, [])) for post in posts]
+
     @classmethod
     def hot_posts(cls, count=8, order="view_count desc"):
-        query = DBStats.query.filter_by(public=True).filter_by(target_type=cls.__name__).order_by(order)
-        ids = [stats.target_id for stats in query.limit(count).all()]
-        return [post for post in cls.get_by_ids(ids) if post and post.public]
+        def query(limit):
+            return cls.query.filter_by(public=True).order_by(cls.counter_order(order)).limit(limit).all()
+
+        return common.get_ranked(cls, count, order, query, lambda post: post.public)
 
     @classmethod
     def latest_posts(cls, count=8, order="updated_date desc"):
         return cls.query.filter_by(public=True).order_by(order).limit(count).all()
 
+    def cache_namespaces(self):
+        return ["posts", "post:%s" % self.id]
+
 
 class DBComment(db.Model, ModelMixin, StatsMixin):
     __tablename__ = "db_comment"
@@ -157,8 +180,6 @@ class DBComment(db.Model, ModelMixin, StatsMixin):
     post_id = db.Column(db.Integer, db.ForeignKey(DBPost.__tablename__ + ".id", ondelete="SET NULL"), index=True)
     _post = db.relationship('DBPost', backref=db.backref('comments', lazy='dynamic'))
 
-    _stats_id = db.Column(db.Integer, db.ForeignKey(DBStats.__tablename__ + '.id', ondelete="SET NULL"))
-
     def __init__(self, author, content, post_id, parent_id=-1):
         self.author = author
         self.content = content
@@ -169,6 +190,9 @@ class DBComment(db.Model, ModelMixin, StatsMixin):
     def post(self):
         return DBPost.get_by_id(self.post_id)
 
+    def cache_namespaces(self):
+        return ["comments:%s" % self.post_id]
+
     def to_dict(self):
         res = ModelMixin.to_dict(self)
         if self.deleted:
@@ -198,8 +222,6 @@ class DBPhoto(db.Model, ModelMixin, StatsMixin):
     post_id = db.Column(db.Integer, db.ForeignKey(DBPost.__tablename__ + ".id", ondelete="SET NULL"), index=True)
     _post = db.relationship('DBPost', backref=db.backref('photos', lazy='dynamic'))
 
-    _stats_id = db.Column(db.Integer, db.ForeignKey(DBStats.__tablename__ + '.id', ondelete="SET NULL"))
-
     def __init__(self, url="", real_file="", alt="", mime="application/octet-stream"):
         self.url = url
         self.alt = alt
@@ -212,7 +234,11 @@ class DBPhoto(db.Model, ModelMixin, StatsMixin):
 
     @classmethod
     def hot_photos(cls, count=12, order="like_count desc"):
-        query = DBStats.query.filter_by(public=True).filter_by(target_type=cls.__name__).order_by(order)
-        ids = [stats.target_id for stats in query.limit(count).all()]
-        return [photo for photo in cls.get_by_ids(ids) if photo]
+        def query(limit):
+            return cls.query.filter_by(public=True).order_by(cls.counter_order(order)).limit(limit).all()
+
+        return common.get_ranked(cls, count, order, query, lambda photo: photo.public)
+
+    def cache_namespaces(self):
+        return ["posts", "photos", "post:%s" % self.post_id]
 
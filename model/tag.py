@@ -1,7 +1,7 @@
 from datetime import datetime
 from model_bae import ModelMixin, StatsMixin,db
-from stats import DBStats
 from post import DBPost
+import common
 
 class DBTag(db.Model, ModelMixin, StatsMixin):
     __tablename__ = "db_tag"
@@ -15,12 +15,8 @@ class DBTag(db.Model, ModelMixin, StatsMixin):
 
     name = db.Column(db.String(64))
 
-    post_count = db.Column(db.Integer, default=0)
-
     _post_id_list = db.Column(db.Text, default="")
 
-    _stats_id = db.Column(db.Integer, db.ForeignKey(DBStats.__tablename__ + '.id', ondelete="SET NULL"))
-
     def __init__(self, name):
         self.name = name.strip()
         self._norm_name = name.strip().lower()
@@ -44,6 +40,7 @@ class DBTag(db.Model, ModelMixin, StatsMixin):
             self.post_count += 1
             self._post_id_list += "," + str(post_id)
             self.save()
+            self.rank("post_count")
 
     def remove_post_id(self, post_id):
         post_id = str(post_id)
@@ -53,6 +50,7 @@ class DBTag(db.Model, ModelMixin, StatsMixin):
             self.post_count -= 1
             self.post_ids = post_ids
             self.save()
+            self.rank("post_count")
 
     def get_posts(self, page=1, per_page=10):
         posts_list = map(long, self.post_ids)
@@ -62,13 +60,23 @@ class DBTag(db.Model, ModelMixin, StatsMixin):
 
     @classmethod
     def hot_tags(cls, count=16):
-        query = DBTag.query.order_by("post_count desc").filter(DBTag.post_count > 0)
-        return query.limit(count).all()
+        def query(limit):
+            return DBTag.query.order_by(DBTag.post_count.desc()).filter(DBTag.post_count > 0).limit(limit).all()
+
+        return common.get_ranked(DBTag, count, "post_count desc", query, lambda tag: tag.post_count > 0)
 
     @classmethod
     def get_tag_by_name(cls, name):
         return DBTag.filter_one(_norm_name=name.strip().lower())
 
+    def to_dict(self):
+        res = ModelMixin.to_dict(self)
+        res["post_count"] = self.post_count
+        return res
+
+    def cache_namespaces(self):
+        return ["tags", "tag:%s" % self._norm_name]
+
 
 
 
@@ -3,12 +3,13 @@ import hashlib
 
 from model_bae import ModelMixin, StatsMixin, db
 import common
-from stats import DBStats
 
 
 class DBUser(db.Model, ModelMixin, StatsMixin):
     __tablename__ = "db_user"
 
+    shared_cache = True
+
     UserRoles = common.UserRoles
 
     id = db.Column(db.Integer, primary_key=True)
@@ -23,8 +24,6 @@ class DBUser(db.Model, ModelMixin, StatsMixin):
     role = db.Column(db.Enum(*UserRoles), default="User")
     joined_date = db.Column(db.DateTime, default=datetime.utcnow)
 
-    _stats_id = db.Column(db.Integer, db.ForeignKey(DBStats.__tablename__ + '.id', ondelete="SET NULL"))
-
     def __init__(self, email,
                  nickname="", avatar="", role="User", active=True):
         self.email = email
@@ -47,6 +46,9 @@ class DBUser(db.Model, ModelMixin, StatsMixin):
     def get_user_by_email(cls, email):
         return cls.filter_one(email=email)
 
+    def cache_namespaces(self):
+        return ["posts", "users"]  # authors are embedded in cached posts and pages
+
     def to_dict(self):
         res = ModelMixin.to_dict(self)
         res["avatar_url"] = self.avatar_url
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Gully Chen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Import time profiler for instance startup.
+
+usage: python profile_imports.py [--module index] [--top 30] [--sort cumulative|self] [--request /]
+"""
+
+import sys
+import __builtin__
+from time import time as sys_time
+
+
+class ImportProfiler(object):
+    """ Times the first import of every module.
+
+    `cumulative` includes the modules imported while loading it, `self`
+    does not.  Imports of modules already loaded are not counted.
+    """
+
+    def __init__(self):
+        self.stats = {}  # module => {"cumulative": seconds, "self": seconds}
+        self._children = []  # time spent in nested imports, per level
+        self._import = None
+
+    def start(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+
+    def stop(self):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = len(sys.modules)
+        self._children.append(0.0)
+        start = sys_time()
+        try:
+            module = self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = sys_time() - start
+            children = self._children.pop()
+
+        if len(sys.modules) > loaded:
+            if fromlist or "." not in name:
+                name = getattr(module, "__name__", name)
+            stats = self.stats.setdefault(name, {"cumulative": 0.0, "self": 0.0})
+            stats["cumulative"] += elapsed
+            stats["self"] += elapsed - children
+
+        if self._children:
+            self._children[-1] += elapsed
+        return module
+
+    def report(self, top=30, sort="cumulative"):
+        total = sum(stats["self"] for stats in self.stats.itervalues())
+        lines = ["%10s %10s  %s" % ("cumul ms", "self ms", "module")]
+        items = sorted(self.stats.iteritems(), key=lambda item: -item[1][sort])
+        for name, stats in items[:top]:
+            lines.append("%10.1f %10.1f  %s" % (stats["cumulative"] * 1000, stats["self"] * 1000, name))
+        lines.append("%d modules, %.1f ms in total" % (len(self.stats), total * 1000))
+        return "\n".join(lines)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="profile the imports of ME@deepgully startup")
+    parser.add_argument("--module", default="index", help="module to import, default index")
+    parser.add_argument("--top", type=int, default=30, help="modules to list")
+    parser.add_argument("--sort", choices=["cumulative", "self"], default="cumulative")
+    parser.add_argument("--request", default=None,
+                        help="path requested once after the import, to time the first request "
+                             "and the database bootstrap it runs")
+    options = parser.parse_args()
+
+    profiler = ImportProfiler()
+    profiler.start()
+    try:
+        __import__(options.module)
+    finally:
+        profiler.stop()
+
+    print profiler.report(options.top, options.sort)
+
+    if options.request is not None:
+        from settings import app
+
+        start = sys_time()
+        response = app.test_client().get(options.request)
+        print "first request %s: %s in %.1f ms" % (options.request, response.status_code,
+                                                   (sys_time() - start) * 1000)
+
+
+if __name__ == '__main__':
+    main()
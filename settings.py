@@ -84,10 +84,16 @@ elif RUNTIME_ENV in ("gae", "gae_dev"):
 
 
 if RUNTIME_ENV in ("bae", "local"):
-    from alembic.config import Config
-    MIGRATE_CFG = Config("alembic.ini")
-    MIGRATE_CFG.set_section_option("alembic", "sqlalchemy.url", app.config['SQLALCHEMY_DATABASE_URI'])
-    app.config['MIGRATE_CFG'] = MIGRATE_CFG
+    def migrate_config():
+        """ alembic config, built on demand because alembic is slow to import """
+        from alembic.config import Config
+        config = Config("alembic.ini")
+        config.set_section_option("alembic", "sqlalchemy.url", app.config['SQLALCHEMY_DATABASE_URI'])
+        return config
+
+
+# entities loaded by one request are kept in its identity map, 0 for no limit
+IDENTITY_MAP_MAX_ITEMS = 2000
 
 
 app.config["SiteTitle"] = "ME@deepgully"
@@ -99,6 +105,7 @@ app.config["DefaultPassword"] = "admin"
 ######################################
 ## User
 ######################################
+# imported eagerly: every request loads its user, and flask_login costs ~15 ms
 from flask.ext.login import LoginManager
 
 login_manager = LoginManager()
@@ -121,8 +128,14 @@ elif RUNTIME_ENV in ("local",):
     app.config['MAIL_USERNAME '] = "test"
     app.config['MAIL_PASSWORD '] = "test"
 
-    from flask_mail import Mail
-    mail = Mail(app)
+    _mail = []
+
+    def get_mail():
+        """ flask_mail is loaded when the first mail is sent """
+        if not _mail:
+            from flask_mail import Mail
+            _mail.append(Mail(app))
+        return _mail[0]
 
 elif RUNTIME_ENV in ("gae", "gae_dev"):
     pass
@@ -155,6 +168,9 @@ app.config["THUMB_SIZE"] = THUMB_SIZE
 ######################################
 ## i18n
 ######################################
+# imported eagerly although it costs ~250 ms: every template calls _(), and
+# lazy_gettext strings are built at import by ajax and utils, so deferring it
+# would only move the cost into the first request, /_ah/warmup on GAE
 from flask.ext.babel import Babel
 from flask.ext.babel import gettext, lazy_gettext
 _ = gettext
@@ -173,3 +189,61 @@ ENABLE_MEMCACHE = True
 if RUNTIME_ENV in ("bae",):
     ENABLE_MEMCACHE = False  # default to disable memcache for BAE because it's not free
 
+# budgets of the in-process memcache used when no memcache service is bound,
+# MEMCACHE_MAX_ITEMS also bounds the files of each "filesystem" CACHE_SERVERS
+MEMCACHE_MAX_ITEMS = 5000
+MEMCACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# in-process L1 cache of unpickled objects in front of memcache
+CACHE_L1_MAX_ITEMS = 1000
+CACHE_L1_TIMEOUT = 10  # seconds, bounds staleness across processes
+
+# cached values whose pickle is larger than this are stored zlib compressed
+CACHE_COMPRESS_THRESHOLD = 4 * 1024
+
+# shared cache of the local runtime, so that every worker process sees the
+# same entries: "local" (per-process LRU), "memcached", "redis" or
+# "filesystem". Keys are spread over CACHE_SERVERS by consistent hashing,
+# e.g. ["127.0.0.1:11211", "127.0.0.1:11212"] or ["/tmp/me_cache"].
+CACHE_BACKEND = "local"
+CACHE_SERVERS = []
+CACHE_DEFAULT_TIMEOUT = 3600 * 24
+
+# rendered pages served to anonymous visitors, also invalidated by content writes
+PAGE_CACHE_TIME = 600
+
+# unknown category urls, tag names and post ids remembered per process,
+# so that 404 storms from crawlers do not reach the database
+NEGATIVE_CACHE_MAX_ITEMS = 2000
+NEGATIVE_CACHE_TIME = 30
+
+
+######################################
+## stats counters
+######################################
+# view and like counts are buffered and written at most once per item
+# every STATS_FLUSH_INTERVAL seconds
+STATS_FLUSH_INTERVAL = 10
+
+# SQL: counts are buffered per process and written with one UPDATE every
+# STATS_FLUSH_INTERVAL seconds, or as soon as this many rows are pending
+STATS_BUFFER_MAX_ITEMS = 500
+
+# GAE: flushed counts go to one of STATS_SHARDS shard entities, which are
+# folded into their entity every STATS_ROLLUP_INTERVAL seconds.  The rollup is a
+# cross-group transaction, so STATS_SHARDS must stay below 25.
+STATS_SHARDS = 10
+STATS_ROLLUP_INTERVAL = 300
+
+# hot posts, photos and tags are read from the top LEADERBOARD_SIZE items of
+# each counter, updated as counts are written and rebuilt by a query every
+# LEADERBOARD_TIME seconds.  Larger hot lists are queried directly.
+LEADERBOARD_SIZE = 50
+LEADERBOARD_TIME = 3600 * 6
+
+
+######################################
+## warmup
+######################################
+WARMUP_TIME_BUDGET = 20  # seconds, GAE warmup requests have a 60s deadline
+WARMUP_WORKERS = 4
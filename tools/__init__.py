@@ -22,3 +22,17 @@ __all__ = [
 from common import *
 
 exec("from tools_%s import *" % RUNTIME_ENV.split("_")[0]) in locals()
+
+from settings import CACHE_L1_MAX_ITEMS, CACHE_L1_TIMEOUT, CACHE_COMPRESS_THRESHOLD
+from cache import TieredCache, Generations
+
+cache = TieredCache(memcache, CACHE_L1_MAX_ITEMS, CACHE_L1_TIMEOUT, CACHE_COMPRESS_THRESHOLD)
+generations = Generations(memcache)
+
+from settings import NEGATIVE_CACHE_MAX_ITEMS, NEGATIVE_CACHE_TIME
+from cache import NegativeCache
+negative_cache = NegativeCache(generations, NEGATIVE_CACHE_MAX_ITEMS, NEGATIVE_CACHE_TIME)
+
+from settings import LEADERBOARD_SIZE, LEADERBOARD_TIME
+from cache import Leaderboards
+leaderboards = Leaderboards(memcache, LEADERBOARD_SIZE, LEADERBOARD_TIME)
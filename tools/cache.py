@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Gully Chen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Cache layers on top of the bound memcache
+"""
+
+import threading
+import zlib
+from time import sleep
+
+from common import LRUCache, sys_time, pickle
+
+
+def key_family(key):
+    """ "category_id:1_posts_page:1@123" => "category_id:*" """
+    family = key.split("@", 1)[0]
+    if ":" in family:
+        family = family.split(":", 1)[0] + ":*"
+    return family
+
+
+class KeyStats(object):
+    """ Cache counters per key family plus the largest values seen. """
+    TOP_KEYS = 20
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.families = {}
+        self.largest = []  # [(size, key), ...] sorted by size desc
+
+    def _get(self, key):
+        family = key_family(key)
+        stats = self.families.get(family)
+        if stats is None:
+            stats = self.families[family] = {
+                "l1_hits": 0, "l2_hits": 0, "misses": 0,
+                "fills": 0, "fill_time": 0.0, "max_fill_time": 0.0,
+                "sets": 0, "set_bytes": 0, "stored_bytes": 0, "max_size": 0,
+                "l1_evictions": 0, "evictions": 0,
+            }
+        return stats
+
+    def incr(self, key, name, delta=1):
+        with self._lock:
+            self._get(key)[name] += delta
+
+    def filled(self, key, seconds):
+        with self._lock:
+            stats = self._get(key)
+            stats["fills"] += 1
+            stats["fill_time"] += seconds
+            stats["max_fill_time"] = max(stats["max_fill_time"], seconds)
+
+    def stored(self, key, size, stored_size=None):
+        with self._lock:
+            stats = self._get(key)
+            stats["sets"] += 1
+            stats["set_bytes"] += size
+            stats["stored_bytes"] += size if stored_size is None else stored_size
+            stats["max_size"] = max(stats["max_size"], size)
+
+            largest = [item for item in self.largest if item[1] != key]
+            if len(largest) < self.TOP_KEYS or size > largest[-1][0]:
+                largest.append((size, key))
+                largest.sort(reverse=True)
+            self.largest = largest[:self.TOP_KEYS]
+
+    def evicted(self, key, size=0):
+        self.incr(key, "evictions")
+
+    def l1_evicted(self, key, size=0):
+        self.incr(key, "l1_evictions")
+
+    def snapshot(self):
+        with self._lock:
+            families = {}
+            for family, stats in self.families.iteritems():
+                stats = dict(stats)
+                hits = stats["l1_hits"] + stats["l2_hits"]
+                stats["hit_ratio"] = _ratio(hits, stats["misses"])
+                stats["avg_fill_time"] = stats["fill_time"] / stats["fills"] if stats["fills"] else 0.0
+                stats["avg_size"] = stats["set_bytes"] / stats["sets"] if stats["sets"] else 0
+                stats["compression_ratio"] = (float(stats["stored_bytes"]) / stats["set_bytes"]
+                                              if stats["set_bytes"] else 1.0)
+                families[family] = stats
+            return {
+                "families": families,
+                "largest_keys": [{"key": key, "size": size} for size, key in self.largest],
+            }
+
+
+class Pickled(object):
+    """ pickle of a cached value, which memcache stores as it is instead
+    of pickling the value a second time """
+    __slots__ = ("data", )
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getstate__(self):
+        return self.data
+
+    def __setstate__(self, data):
+        self.data = data
+
+    def load(self):
+        return pickle.loads(self.data)
+
+
+class Compressed(Pickled):
+    """ zlib compressed pickle of a cached value """
+    __slots__ = ()
+
+    def load(self):
+        return pickle.loads(zlib.decompress(self.data))
+
+
+class TieredCache(object):
+    """ Two-tier cache: an in-process L1 of unpickled objects in front of memcache.
+
+    L1 hands out the very same object to every caller, so cached values
+    must be treated as read-only.  L1 entries live at most `l1_timeout`
+    seconds, which bounds staleness against writes made by other processes.
+    Objects which are bound to a database session should be cached with
+    l1=False.
+    """
+    LOCK_KEY = "LOCK:%s"
+    STALE_KEY = "STALE:%s"
+    LOCK_TIMEOUT = 10  # seconds a filler may hold the lock
+    FILL_WAIT = 1.0  # seconds a waiter polls for the filler's result
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, memcache, l1_max_items=1000, l1_timeout=10,
+                 compress_threshold=None, compress_level=6):
+        self.memcache = memcache
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.compressed = self.raw_bytes = self.compressed_bytes = 0
+        self.l1 = LRUCache(max_items=l1_max_items, default_timeout=l1_timeout)
+        self.l1_timeout = l1_timeout
+        self.l2_hits = self.l2_misses = 0
+
+        self.key_stats = KeyStats()
+        self.l1.on_evict = self.key_stats.l1_evicted
+        if isinstance(memcache, LRUCache):
+            memcache.on_evict = self.key_stats.evicted
+
+        self._inflight = {}  # key => threading.Event of the filling thread
+        self._inflight_lock = threading.Lock()
+        self.fills = self.fills_avoided = self.stale_served = self.lock_timeouts = 0
+        self.refreshes = 0
+
+    def __getattr__(self, name):
+        # other memcache functions go to the backend directly
+        return getattr(self.memcache, name)
+
+    def _l1_set(self, key, value, time=None):
+        if time:
+            time = min(time, self.l1_timeout)
+        self.l1.set(key, value, time)
+
+    def _dump(self, key, value):
+        """ value to send to memcache, pickled once here and compressed above
+        compress_threshold """
+        try:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.key_stats.stored(key, 0)
+            return value
+
+        size = len(data)
+        if self.compress_threshold is None or size < self.compress_threshold:
+            self.key_stats.stored(key, size)
+            return Pickled(data)
+
+        data = zlib.compress(data, self.compress_level)
+        self.key_stats.stored(key, size, len(data))
+        self.compressed += 1
+        self.raw_bytes += size
+        self.compressed_bytes += len(data)
+        return Compressed(data)
+
+    @staticmethod
+    def _load(value):
+        if isinstance(value, Pickled):
+            return value.load()
+        return value
+
+    def get(self, key, l1=True):
+        if l1:
+            value = self.l1.get(key)
+            if value is not None:
+                self.key_stats.incr(key, "l1_hits")
+                return value
+
+        value = self._load(self.memcache.get(key))
+        if value is None:
+            self.l2_misses += 1
+            self.key_stats.incr(key, "misses")
+        else:
+            self.l2_hits += 1
+            self.key_stats.incr(key, "l2_hits")
+            if l1:
+                self._l1_set(key, value)
+        return value
+
+    def get_multi(self, keys, l1=True):
+        """ get many keys, with one memcache round trip for the L1 misses """
+        res = {}
+        missing = []
+        for key in keys:
+            value = self.l1.get(key) if l1 else None
+            if value is None:
+                missing.append(key)
+            else:
+                self.key_stats.incr(key, "l1_hits")
+                res[key] = value
+
+        if missing:
+            found = self.memcache.get_multi(missing) or {}
+            self.l2_hits += len(found)
+            self.l2_misses += len(missing) - len(found)
+            for key in missing:
+                self.key_stats.incr(key, "l2_hits" if key in found else "misses")
+            for key, value in found.iteritems():
+                value = self._load(value)
+                if l1:
+                    self._l1_set(key, value)
+                res[key] = value
+        return res
+
+    def set(self, key, value, time=0, l1=True):
+        if l1:
+            self._l1_set(key, value, time)
+        else:
+            self.l1.delete(key)
+        return self.memcache.set(key, self._dump(key, value), time)
+
+    def set_multi(self, mapping, time=0, l1=True):
+        for key, value in mapping.iteritems():
+            if l1:
+                self._l1_set(key, value, time)
+            else:
+                self.l1.delete(key)
+        return self.memcache.set_multi(dict((key, self._dump(key, value))
+                                            for key, value in mapping.iteritems()), time)
+
+    def add(self, key, value, time=0):
+        return self.memcache.add(key, value, time)
+
+    def _fill(self, key, fill, args, time, l1, stale_key, cache_empty, soft_time):
+        start = sys_time()
+        value = fill(*args)
+        self.key_stats.filled(key, sys_time() - start)
+        self.fills += 1
+        if value or (cache_empty and value is not None):
+            if soft_time:
+                stored = (sys_time() + soft_time, value)
+            else:
+                stored = value
+            self.set(key, stored, time, l1)
+            if stale_key:
+                self.set(self.STALE_KEY % stale_key, stored, time, l1=False)
+        return value
+
+    def _wait(self, key, l1, deadline):
+        while sys_time() < deadline:
+            sleep(self.POLL_INTERVAL)
+            value = self.get(key, l1)
+            if value is not None:
+                return value
+        return None
+
+    def _refresh(self, key, fill, args, time, l1, stale_key, cache_empty, soft_time):
+        self.l1.delete(key)  # pick up the refreshed value from memcache
+        if self.memcache.add(self.LOCK_KEY % key, 1, self.LOCK_TIMEOUT):
+            from tools import run_in_background
+
+            self.refreshes += 1
+            run_in_background(refresh_entry, key, fill, args, time, l1, stale_key, cache_empty, soft_time)
+
+    def get_or_fill(self, key, fill, time=0, l1=True, stale_key=None, cache_empty=True,
+                    soft_time=None, args=()):
+        """ get `key`, calling `fill(*args)` once to recompute it on a miss.
+
+        Concurrent misses on the same key are collapsed: threads of this
+        process wait for the filling thread, other processes are held off
+        by a short-lived memcache lock taken with add().  Waiters get the
+        previous value stored under `stale_key` if there is one, otherwise
+        they poll for the new value for up to FILL_WAIT seconds.
+
+        With `soft_time`, entries older than `soft_time` seconds are still
+        served until the hard expiry `time`, while one background task
+        recomputes them (stale-while-revalidate).  `fill` must then be a
+        module level function so it can be deferred.
+        """
+        def unwrap(stored):
+            if soft_time and stored is not None:
+                return stored[1]
+            return stored
+
+        def fill_value():
+            return self._fill(key, fill, args, time, l1, stale_key, cache_empty, soft_time)
+
+        value = self.get(key, l1)
+        if value is not None:
+            if soft_time and value[0] <= sys_time():
+                self._refresh(key, fill, args, time, l1, stale_key, cache_empty, soft_time)
+            return unwrap(value)
+
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        if not leader:
+            value = stale_key and self.get(self.STALE_KEY % stale_key, l1=False)
+            if value is not None:
+                self.stale_served += 1
+                self.fills_avoided += 1
+                return unwrap(value)
+            event.wait(self.FILL_WAIT)
+            value = self.get(key, l1)
+            if value is not None:
+                self.fills_avoided += 1
+                return unwrap(value)
+            return fill_value()
+
+        try:
+            lock_key = self.LOCK_KEY % key
+            if self.memcache.add(lock_key, 1, self.LOCK_TIMEOUT):
+                try:
+                    return fill_value()
+                finally:
+                    self.memcache.delete(lock_key)
+
+            # another process is filling this key
+            value = stale_key and self.get(self.STALE_KEY % stale_key, l1=False)
+            if value is not None:
+                self.stale_served += 1
+                self.fills_avoided += 1
+                return unwrap(value)
+            value = self._wait(key, l1, sys_time() + self.FILL_WAIT)
+            if value is not None:
+                self.fills_avoided += 1
+                return unwrap(value)
+            self.lock_timeouts += 1
+            return fill_value()
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def delete(self, key):
+        self.l1.delete(key)
+        return self.memcache.delete(key)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.l1.delete(key)
+        return self.memcache.delete_multi(keys)
+
+    def flush_all(self):
+        self.l1.clear()
+        return self.memcache.flush_all()
+
+    def get_key_stats(self):
+        return self.key_stats.snapshot()
+
+    def get_stats(self):
+        l1 = self.l1.get_stats()
+        stats = {
+            "l1": {
+                "hits": l1["hits"],
+                "misses": l1["misses"],
+                "hit_ratio": _ratio(l1["hits"], l1["misses"]),
+                "items": l1["items"],
+                "evictions": l1["evictions"],
+            },
+            "l2": {
+                "hits": self.l2_hits,
+                "misses": self.l2_misses,
+                "hit_ratio": _ratio(self.l2_hits, self.l2_misses),
+            },
+            "fills": {
+                "fills": self.fills,
+                "duplicate_fills_avoided": self.fills_avoided,
+                "stale_served": self.stale_served,
+                "lock_timeouts": self.lock_timeouts,
+                "background_refreshes": self.refreshes,
+            },
+            "compression": {
+                "threshold": self.compress_threshold,
+                "values": self.compressed,
+                "raw_bytes": self.raw_bytes,
+                "compressed_bytes": self.compressed_bytes,
+                "ratio": float(self.compressed_bytes) / self.raw_bytes if self.raw_bytes else 1.0,
+            },
+        }
+        try:
+            stats["backend"] = self.memcache.get_stats()
+        except Exception:
+            stats["backend"] = None
+        return stats
+
+
+def refresh_entry(key, fill, args, time, l1, stale_key, cache_empty, soft_time):
+    """ background task recomputing an entry served stale by get_or_fill """
+    from tools import cache
+
+    try:
+        cache._fill(key, fill, args, time, l1, stale_key, cache_empty, soft_time)
+    finally:
+        cache.memcache.delete(cache.LOCK_KEY % key)
+
+
+class Generations(object):
+    """ Namespace generation counters folded into cache keys.
+
+    Cached values are stored under keys carrying the current generation of
+    every namespace they depend on ("posts", "category:<id>", "tag:<name>"
+    ...), so bumping a generation invalidates all of them at once and the
+    old entries simply age out of memcache.
+    """
+    KEY = "GEN:%s"
+
+    def __init__(self, memcache):
+        self.memcache = memcache
+
+    @staticmethod
+    def _initial():
+        # start from a timestamp so a lost counter never revives old keys
+        return int(sys_time() * 1000)
+
+    def get_multi(self, namespaces):
+        keys = dict((self.KEY % ns, ns) for ns in namespaces)
+        found = self.memcache.get_multi(keys.keys()) or {}
+
+        gens = {}
+        for key, ns in keys.iteritems():
+            gen = found.get(key)
+            if gen is None:
+                gen = self._initial()
+                if not self.memcache.add(key, gen):
+                    gen = self.memcache.get(key) or gen
+            gens[ns] = gen
+        return gens
+
+    def fold(self, key, *namespaces):
+        """ return `key` tagged with the generations of `namespaces` """
+        return self.fold_multi([(key, namespaces)])[0]
+
+    def fold_multi(self, items):
+        """ fold a list of (key, namespaces) with one memcache round trip """
+        gens = self.get_multi(set(ns for _, namespaces in items for ns in namespaces))
+        return ["%s@%s" % (key, "-".join(str(gens[ns]) for ns in namespaces))
+                for key, namespaces in items]
+
+    def bump(self, *namespaces):
+        if not namespaces:
+            return
+        keys = dict((self.KEY % ns, 1) for ns in namespaces)
+        offset_multi = getattr(self.memcache, "offset_multi", None)
+        if offset_multi is not None:
+            offset_multi(keys, initial_value=self._initial())
+        else:
+            for key in keys:
+                self.memcache.incr(key, initial_value=self._initial())
+
+
+class NegativeCache(object):
+    """ Bounded in-process cache of lookups that found nothing.
+
+    Each entry remembers the generation of its namespace, so creating the
+    missing item bumps it and voids the entry in every process.  The short
+    timeout bounds the cost of a creation racing with a lookup.
+    """
+
+    def __init__(self, generations, max_items=2000, timeout=30):
+        self.generations = generations
+        self.timeout = timeout
+        self.entries = LRUCache(max_items, default_timeout=timeout)
+
+    def _generation(self, namespace):
+        return self.generations.get_multi([namespace])[namespace]
+
+    def is_missing(self, namespace, key):
+        """ True if `key` was recently looked up in vain """
+        gen = self.entries.get((namespace, key))
+        if gen is None:
+            return False
+        if gen != self._generation(namespace):
+            self.entries.delete((namespace, key))
+            return False
+        return True
+
+    def add(self, namespace, key):
+        self.entries.set((namespace, key), self._generation(namespace), self.timeout)
+
+    def get_stats(self):
+        return self.entries.get_stats()
+
+
+class Leaderboards(object):
+    """ Top `size` (id, score) pairs per board, highest first, kept in
+    memcache and updated in place as scores are written.
+
+    Boards are built from a query when read and not cached, and updates of
+    boards that are not cached are dropped.  An item whose score falls
+    keeps its place among the items of the board only, so every board is
+    rebuilt `timeout` seconds after it was built.
+    """
+    KEY = "LEADERBOARD:%s"
+    LOCK_KEY = "LEADERBOARD_LOCK:%s"
+    LOCK_TIMEOUT = 5
+    LOCK_WAIT = 0.5  # seconds an update waits for a concurrent one
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, memcache, size=50, timeout=3600):
+        self.memcache = memcache
+        self.size = size
+        self.timeout = timeout
+
+    def _get(self, board):
+        stored = self.memcache.get(self.KEY % board)
+        if stored is None:
+            return None, None
+        built, items = stored
+        if sys_time() - built > self.timeout:
+            return None, None
+        return built, items
+
+    def _store(self, board, built, items):
+        items = sorted(items, key=lambda item: -item[1])[:self.size]
+        time = max(int(built + self.timeout - sys_time()), 1)
+        self.memcache.set(self.KEY % board, (built, items), time)
+
+    def get(self, board):
+        """ ranked ids of `board`, None if it has to be built """
+        built, items = self._get(board)
+        if items is None:
+            return None
+        return [id for id, _ in items]
+
+    def set(self, board, items):
+        """ build `board` from (id, score) pairs """
+        self._store(board, sys_time(), items)
+
+    def update(self, board, scores):
+        """ merge {id: new score} into `board`.  Returns False if a concurrent
+        update held the board too long, the scores are then dropped: their
+        items move on their next update or when the board is rebuilt. """
+        if not scores:
+            return True
+        lock_key = self.LOCK_KEY % board
+        deadline = sys_time() + self.LOCK_WAIT
+        while not self.memcache.add(lock_key, 1, self.LOCK_TIMEOUT):
+            if sys_time() > deadline:
+                return False
+            sleep(self.POLL_INTERVAL)
+        try:
+            built, items = self._get(board)
+            if items is None:
+                return True
+
+            ranked = dict(items)
+            lowest = items[-1][1] if len(items) >= self.size else None
+            for id, score in scores.iteritems():
+                if id in ranked or lowest is None or score > lowest:
+                    ranked[id] = score
+            self._store(board, built, ranked.items())
+            return True
+        finally:
+            self.memcache.delete(lock_key)
+
+    def delete(self, board):
+        return self.memcache.delete(self.KEY % board)
+
+
+def _ratio(hits, misses):
+    total = hits + misses
+    return float(hits) / total if total else 0.0
+
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Gully Chen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Shared cache backends for runtimes without a memcache service
+
+usage: python -m tools.cache_backends [--backend filesystem] [--server /tmp/me_cache]
+checks that the servers add and increment atomically
+"""
+
+import os
+import errno
+from bisect import bisect
+from contextlib import contextmanager
+from hashlib import md5
+from time import sleep
+
+from werkzeug.contrib.cache import MemcachedCache, RedisCache, FileSystemCache
+
+from common import sys_time
+
+
+class FileSystemNode(FileSystemCache):
+    """ cache files in a directory shared by the processes of one host.
+
+    add() and inc() hold a lock file of the key, created with O_EXCL, so
+    fill locks and generation bumps are atomic across processes.  Reads
+    touch the files, and past `threshold` files the least recently used
+    ones are removed, once every PRUNE_INTERVAL sets.
+    """
+    LOCK_SUFFIX = ".lock"
+    LOCK_TIMEOUT = 5  # seconds, locks of crashed processes are broken after
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, cache_dir, threshold=5000, default_timeout=300, mode=0600):
+        FileSystemCache.__init__(self, cache_dir, threshold, default_timeout, mode)
+        self._sets = 0
+
+    @contextmanager
+    def _locked(self, key):
+        # the transaction suffix keeps lock files out of _list_dir
+        lock = self._get_filename(key) + self.LOCK_SUFFIX + self._fs_transaction_suffix
+        while True:
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, self._mode))
+                break
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if sys_time() - os.path.getmtime(lock) > self.LOCK_TIMEOUT:
+                    os.remove(lock)
+            except OSError:
+                pass
+            sleep(0.001)
+        try:
+            yield
+        finally:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+    def _prune(self):
+        self._sets += 1
+        if self._sets % self.PRUNE_INTERVAL:
+            return
+        entries = []
+        for filename in self._list_dir():
+            try:
+                entries.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+        if len(entries) <= self._threshold:
+            return
+        entries.sort()
+        for _, filename in entries[:len(entries) - self._threshold]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def get(self, key):
+        value = FileSystemCache.get(self, key)
+        if value is not None:
+            try:
+                os.utime(self._get_filename(key), None)
+            except OSError:
+                pass
+        return value
+
+    def add(self, key, value, timeout=None):
+        with self._locked(key):
+            if FileSystemCache.get(self, key) is not None:
+                return False
+            self.set(key, value, timeout)
+            return True
+
+    def inc(self, key, delta=1):
+        with self._locked(key):
+            value = (FileSystemCache.get(self, key) or 0) + delta
+            self.set(key, value)
+            return value
+
+
+class MemcachedNode(MemcachedCache):
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        return bool(self._client.add(key, value, timeout))
+
+    def inc(self, key, delta=1):
+        if delta < 0:
+            return self._client.decr(key, -delta)
+        return self._client.incr(key, delta)
+
+
+class RedisNode(RedisCache):
+    def add(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        # one SET so that the key cannot be left without its expiration,
+        # needs redis-py 2.7.4 and Redis 2.6.12
+        added = self._client.set(self.key_prefix + key, self.dump_object(value), nx=True, ex=timeout)
+        return bool(added)
+
+
+def make_cache_node(backend, server, default_timeout, max_items=5000):
+    """ create a werkzeug cache for one server of CACHE_SERVERS.  `max_items`
+    bounds the files of a "filesystem" node. """
+    if backend == "memcached":
+        return MemcachedNode([server], default_timeout)
+    elif backend == "redis":
+        host, _, port = server.partition(":")
+        return RedisNode(host, int(port or 6379), default_timeout=default_timeout)
+    elif backend == "filesystem":
+        return FileSystemNode(server, threshold=max_items, default_timeout=default_timeout)
+    raise Exception("unsupported cache backend %s" % backend)
+
+
+def _hash(key):
+    return int(md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+    """ Consistent hash ring, adding or removing a node only moves 1/N of the keys """
+    REPLICAS = 100  # virtual nodes per server, smooths the distribution
+
+    def __init__(self, names, replicas=REPLICAS):
+        ring = sorted((_hash("%s#%d" % (name, i)), name)
+                      for name in names for i in xrange(replicas))
+        self._hashes = [h for h, _ in ring]
+        self._names = [name for _, name in ring]
+
+    def get_node(self, key):
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._names[index]
+
+
+class ShardedCache(object):
+    """ memcache compatible client spreading keys over werkzeug cache nodes.
+
+    `nodes` is a list of (name, cache) pairs; the name (usually the server
+    address) places the node on the hash ring, so it must stay stable.
+    Every process sharing the same CACHE_SERVERS sees the same cache.
+    """
+    MAX_KEY_LENGTH = 200
+
+    def __init__(self, nodes, default_timeout=3600 * 24):
+        self.nodes = dict(nodes)
+        self.ring = HashRing(self.nodes.keys())
+        self.default_timeout = default_timeout
+
+    @classmethod
+    def _norm_key(cls, key):
+        # memcached refuses long keys and whitespace
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        if len(key) > cls.MAX_KEY_LENGTH or any(c in key for c in " \t\r\n"):
+            key = "H:" + md5(key).hexdigest()
+        return key
+
+    def _timeout(self, time):
+        if not time:
+            return self.default_timeout
+        if time > 3600 * 24 * 30:  # absolute timestamp
+            return max(int(time - sys_time()), 1)
+        return time
+
+    def _node(self, key):
+        return self.nodes[self.ring.get_node(key)]
+
+    def _group(self, keys):
+        groups = {}
+        for key in keys:
+            norm_key = self._norm_key(key)
+            groups.setdefault(self.ring.get_node(norm_key), []).append((norm_key, key))
+        return groups
+
+    def get(self, key):
+        key = self._norm_key(key)
+        return self._node(key).get(key)
+
+    def get_multi(self, keys, key_prefix=""):
+        res = {}
+        for name, pairs in self._group([key_prefix + key for key in keys]).iteritems():
+            values = self.nodes[name].get_many(*[norm_key for norm_key, _ in pairs])
+            for (_, key), value in zip(pairs, values):
+                if value is not None:
+                    res[key[len(key_prefix):]] = value
+        return res
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        key = self._norm_key(key)
+        self._node(key).set(key, value, self._timeout(time))
+        return True
+
+    def set_multi(self, mapping, time=0, key_prefix="", min_compress_len=0):
+        for name, pairs in self._group([key_prefix + key for key in mapping]).iteritems():
+            self.nodes[name].set_many(dict((norm_key, mapping[key[len(key_prefix):]])
+                                           for norm_key, key in pairs),
+                                      self._timeout(time))
+        return []
+
+    def add(self, key, value, time=0, min_compress_len=0):
+        key = self._norm_key(key)
+        return self._node(key).add(key, value, self._timeout(time))
+
+    def replace(self, key, value, time=0, min_compress_len=0):
+        if self.get(key) is None:
+            return False
+        return self.set(key, value, time)
+
+    def incr(self, key, delta=1, initial_value=None):
+        key = self._norm_key(key)
+        node = self._node(key)
+        if node.get(key) is None:
+            if initial_value is None:
+                return None
+            node.add(key, initial_value, self.default_timeout)
+        return node.inc(key, delta)
+
+    def decr(self, key, delta=1, initial_value=None):
+        return self.incr(key, -delta, initial_value)
+
+    def offset_multi(self, mapping, key_prefix="", initial_value=None):
+        return dict((key, self.incr(key_prefix + key, delta, initial_value))
+                    for key, delta in mapping.iteritems())
+
+    def delete(self, key, seconds=0):
+        key = self._norm_key(key)
+        self._node(key).delete(key)
+        return True
+
+    def delete_multi(self, keys, seconds=0, key_prefix=""):
+        for name, pairs in self._group([key_prefix + key for key in keys]).iteritems():
+            self.nodes[name].delete_many(*[norm_key for norm_key, _ in pairs])
+        return True
+
+    def flush_all(self):
+        for node in self.nodes.itervalues():
+            node.clear()
+        return True
+
+    def get_stats(self):
+        return {"nodes": sorted(self.nodes.keys())}
+
+
+def _race(args):
+    backend, server, rounds, prefix = args
+    node = make_cache_node(backend, server, 60)
+    won = 0
+    for i in xrange(rounds):
+        if node.add("%s:lock:%d" % (prefix, i), 1, 60):
+            won += 1
+        node.inc(prefix + ":counter")
+    return won
+
+
+def check_node(backend, server, workers=4, rounds=200):
+    """ race `workers` processes on add() and inc() of one server.  Every
+    lock must be won once and no increment lost, or the server can not hold
+    the fill locks and generations of TieredCache. """
+    from multiprocessing import Pool
+
+    prefix = "check:%d" % int(sys_time() * 1000)
+    node = make_cache_node(backend, server, 60)
+    node.add(prefix + ":counter", 0, 60)
+
+    pool = Pool(workers)
+    try:
+        won = sum(pool.map(_race, [(backend, server, rounds, prefix)] * workers))
+    finally:
+        pool.close()
+        pool.join()
+
+    counter = int(node.get(prefix + ":counter") or 0)
+    return {"locks": won, "expected_locks": rounds,
+            "counter": counter, "expected_counter": workers * rounds,
+            "ok": won == rounds and counter == workers * rounds}
+
+
+def main():
+    import argparse
+    from settings import CACHE_BACKEND, CACHE_SERVERS
+
+    parser = argparse.ArgumentParser(description="check that cache servers add and increment atomically")
+    parser.add_argument("--backend", default=CACHE_BACKEND, help="memcached, redis or filesystem")
+    parser.add_argument("--server", action="append", help="server to check, default CACHE_SERVERS")
+    parser.add_argument("--workers", type=int, default=4, help="racing processes")
+    parser.add_argument("--rounds", type=int, default=200, help="locks and increments per process")
+    options = parser.parse_args()
+
+    for server in options.server or CACHE_SERVERS:
+        res = check_node(options.backend, server, options.workers, options.rounds)
+        print "%s %s: %s" % (options.backend, server, "ok" if res["ok"] else "FAILED"), res
+
+
+if __name__ == '__main__':
+    main()
@@ -101,9 +101,31 @@ def save_photo(binary):
     return url, real_file, url_thumb, real_file_thumb, mime
 
 
+############################################
+## Background tasks
+############################################
+def run_in_background(func, *args, **kwargs):
+    """ run func in a daemon thread with its own application context,
+    tools_gae runs it in a deferred task instead """
+    from threading import Thread
+
+    def run():
+        with app.app_context():
+            try:
+                func(*args, **kwargs)
+            except:
+                logging.exception("background task error")
+
+    thread = Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+
 ######################################
 ## memcache
 ######################################
+import threading
+from collections import OrderedDict
 from time import time as sys_time
 try:
     import cPickle as pickle
@@ -111,95 +133,219 @@ except ImportError:
     import pickle
 
 
-class memcache():
-    """ Dummy memcache class for compatibility
+class LRUCache(object):
+    """ Thread-safe LRU cache engine with item and byte budgets.
+
+    Items are kept in an OrderedDict in least-recently-used order, so
+    lookups, refreshes and evictions are all O(1).  Expired items are
+    dropped lazily when they are read or reach the LRU end.
     """
-    mem_cache = {}
-    MAX_ITEMS = 500
     DEFAULT_TIMEOUT = 3600 * 24
 
-    @classmethod
-    def _prune(cls):
-        if len(cls.mem_cache) > cls.MAX_ITEMS:
-            now = sys_time()
-            for idx, (key, (expires, _)) in enumerate(cls.mem_cache.items()):
-                if expires <= now or idx % 3 == 0:
-                    cls.mem_cache.pop(key, None)
-
-    @classmethod
-    def get(cls, key):
-        expires, value = cls.mem_cache.get(key, (0, None))
-        if expires > sys_time():
-            return pickle.loads(value)
-        return None
-
-    @classmethod
-    def get_multi(cls, keys, key_prefix=None):
-        res = {}
-        for key in keys:
-            if key_prefix is not None:
-                key = key_prefix + key
-
-            res[key] = cls.get(key)
-        return res
-
-    @classmethod
-    def set(cls, key, value, time=None, min_compress_len=0):
-        if time is None:
-            time = cls.DEFAULT_TIMEOUT
-
-        cls._prune()
-        cls.mem_cache[key] = (sys_time() + time, pickle.dumps(value,
-                                                          pickle.HIGHEST_PROTOCOL))
+    on_evict = None  # callback(key, size) for live items pushed out by the budgets
+
+    def __init__(self, max_items=500, max_bytes=None, default_timeout=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.default_timeout = default_timeout or self.DEFAULT_TIMEOUT
+
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key => (expires, size, value)
+        self._bytes = 0
+
+        self.hits = self.misses = self.evictions = 0
+        self.byte_hits = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.lookup(key, touch=False) is not None
+
+    def _expires(self, time):
+        if not time:
+            time = self.default_timeout
+        if time > 3600 * 24 * 30:  # memcache treats big values as timestamps
+            return time
+        return sys_time() + time
+
+    def _pop(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._bytes -= item[1]
+        return item
+
+    def _evict(self):
+        now = sys_time()
+        while self._items and (len(self._items) > self.max_items or
+                               (self.max_bytes and self._bytes > self.max_bytes)):
+            key, (expires, size, _) = self._items.popitem(last=False)
+            self._bytes -= size
+            if expires > now:
+                self.evictions += 1
+                if self.on_evict is not None:
+                    self.on_evict(key, size)
+
+    # _lookup and _store expect the lock to be held
+    def _lookup(self, key, touch=True):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[0] <= sys_time():
+            self._pop(key)
+            return None
+        if touch:
+            self._items[key] = self._items.pop(key)
+        return item
+
+    def _store(self, key, value, time=None, size=1):
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        self._pop(key)
+        self._items[key] = (self._expires(time), size, value)
+        self._bytes += size
+        self._evict()
         return True
 
-    @classmethod
-    def set_multi(cls, mapping, time=None, key_prefix=None, min_compress_len=0):
-        res = []
-        for _key, value in mapping.iteritems():
-            if key_prefix is None:
-                key = _key
-            else:
-                key = key_prefix + _key
+    def lookup(self, key, touch=True):
+        """ return (expires, size, value) of a live item or None """
+        with self._lock:
+            return self._lookup(key, touch)
+
+    def store(self, key, value, time=None, size=1):
+        with self._lock:
+            return self._store(key, value, time, size)
+
+    def get(self, key):
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.byte_hits += item[1]
+        return item[2]
+
+    def set(self, key, value, time=None, size=1):
+        return self.store(key, value, time, size)
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "byte_hits": self.byte_hits,
+                "items": len(self._items),
+                "bytes": self._bytes,
+                "evictions": self.evictions,
+            }
+
+
+class LocalMemcache(LRUCache):
+    """ In-process memcache compatible with google.appengine.api.memcache.
+
+    Values are pickled on set, so callers always get their own copy back
+    and the byte budget reflects the real payload size.
+    """
 
-            if not cls.set(key, value, time, min_compress_len):
-                res.append(_key)
+    def get(self, key):
+        value = LRUCache.get(self, key)
+        if value is None:
+            return None
+        return pickle.loads(value)
 
+    def get_multi(self, keys, key_prefix=""):
+        res = {}
+        with self._lock:
+            for key in keys:
+                item = self._lookup(key_prefix + key)
+                if item is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self.byte_hits += item[1]
+                    res[key] = item[2]
+        for key, value in res.iteritems():
+            res[key] = pickle.loads(value)
         return res
 
-    @classmethod
-    def replace(cls, key, value, time=None, min_compress_len=0):
-        return cls.set(key, value, time, min_compress_len)
-
-    @classmethod
-    def incr(cls, key, delta=1):
-        try:
-            value = cls.get(key)
-            value += delta
-            cls.set(key, value)
-            return value
-        except:
-            cls.set(key, delta)
-            return None
-
-    @classmethod
-    def decr(cls, key, delta=1):
-        try:
-            value = cls.gt(key)
-            value -= delta
-            cls.set(key, value)
-            return value
-        except:
-            cls.set(key, delta)
+    def set(self, key, value, time=None, min_compress_len=0):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return self.store(key, value, time, len(value))
+
+    def set_multi(self, mapping, time=None, key_prefix="", min_compress_len=0):
+        data = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                for key, value in mapping.iteritems()]
+        with self._lock:
+            return [key for key, value in data
+                    if not self._store(key_prefix + key, value, time, len(value))]
+
+    def add(self, key, value, time=None, min_compress_len=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._lookup(key, touch=False) is not None:
+                return False
+            return self._store(key, data, time, len(data))
+
+    def replace(self, key, value, time=None, min_compress_len=0):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._lookup(key, touch=False) is None:
+                return False
+            return self._store(key, data, time, len(data))
+
+    def _incr(self, key, delta, initial_value):
+        item = self._lookup(key, touch=False)
+        if item is None:
+            if initial_value is None:
+                return None
+            value = initial_value
+            expires = None
+        else:
+            value = pickle.loads(item[2])
+            expires = item[0]
+        if not isinstance(value, (int, long)):
             return None
+        value = max(value + delta, 0)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._store(key, data, expires, len(data))
+        return value
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self._lock:
+            return self._incr(key, delta, initial_value)
+
+    def decr(self, key, delta=1, initial_value=None):
+        return self.incr(key, -delta, initial_value)
+
+    def offset_multi(self, mapping, key_prefix="", initial_value=None):
+        with self._lock:
+            return dict((key, self._incr(key_prefix + key, delta, initial_value))
+                        for key, delta in mapping.iteritems())
+
+    def delete(self, key, seconds=0):
+        return LRUCache.delete(self, key)
+
+    def delete_multi(self, keys, seconds=0, key_prefix=""):
+        with self._lock:
+            for key in keys:
+                self._pop(key_prefix + key)
+        return True
 
-    @classmethod
-    def delete(cls, key, time=None):
-        res = cls.mem_cache.pop(key, False)
-        return res
+    def flush_all(self):
+        self.clear()
+        return True
 
-    @classmethod
-    def flush_all(cls):
-        cls.mem_cache.clear()
 
+from settings import MEMCACHE_MAX_ITEMS, MEMCACHE_MAX_BYTES
 
+memcache = LocalMemcache(max_items=MEMCACHE_MAX_ITEMS, max_bytes=MEMCACHE_MAX_BYTES)
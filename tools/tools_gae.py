@@ -110,6 +110,16 @@ def make_blob_file_header(blob_key_or_info, content_type=None, save_as=None):
     return headers
 
 
+############################################
+## Background tasks
+############################################
+def run_in_background(func, *args, **kwargs):
+    """ run func in a deferred task, func and args must be picklable """
+    from google.appengine.ext import deferred
+
+    deferred.defer(func, *args, **kwargs)
+
+
 ############################################
 ## memcache
 ############################################
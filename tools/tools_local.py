@@ -24,10 +24,10 @@ def send_mail(body, address, fromaddr=None, subject=None, **kwargs):
     if not isinstance(address, (list, tuple, set)):
         address = [address, ]
 
-    from settings import mail
+    from settings import get_mail
     from flask_mail import Message
     msg = Message(subject, sender=fromaddr, recipients=address, body = body)
-    mail.send(msg)
+    get_mail().send(msg)
 
 
 ############################################
@@ -58,3 +58,16 @@ def delete_file(file_path):
         os.remove(file_path)
 
 
+############################################
+## memcache
+############################################
+from settings import CACHE_BACKEND, CACHE_SERVERS, CACHE_DEFAULT_TIMEOUT, MEMCACHE_MAX_ITEMS
+
+
+if CACHE_BACKEND != "local":
+    from cache_backends import ShardedCache, make_cache_node
+
+    memcache = ShardedCache([(server, make_cache_node(CACHE_BACKEND, server, CACHE_DEFAULT_TIMEOUT,
+                                                      MEMCACHE_MAX_ITEMS))
+                             for server in CACHE_SERVERS],
+                            CACHE_DEFAULT_TIMEOUT)  # bind memcache to shared servers
@@ -16,11 +16,13 @@
 Site utils interact with Flask request, response.
 """
 
-from apis import Anonymous, User, get_site_settings
+from functools import wraps
+from apis import Anonymous, User, Stats, get_site_snapshot
 
 ############################################
 ## common functions
 ############################################
+from flask import request
 from flask import render_template as flask_render_template
 
 
@@ -28,10 +30,133 @@ def render_template(template_name_or_list, **context):
     """add "user" and "settings" for every response"""
     context.update({
         "user": User.get_current_user(),
-        "settings": get_site_settings(),
+        "settings": get_site_snapshot().settings,
     })
     return flask_render_template(template_name_or_list, **context)
 
+
+############################################
+## page cache
+############################################
+from flask import g, session, current_app
+from tools import cache, generations
+from settings import PAGE_CACHE_TIME
+
+PAGE_CACHE_KEY = "page:%s_locale:%s_role:%s_v2"  # v2: views are (model name, id) pairs
+
+
+def expand_namespaces(namespaces, args):
+    """fill namespace format strings, or call namespace callables, with the view arguments"""
+    return [ns(args) if callable(ns) else ns % args for ns in namespaces]
+
+
+def count_view(item):
+    """increase view_count of item, replayed when the page is served from cache"""
+    stats = item.stats
+    stats.increase("view_count")
+    if hasattr(g, "page_views"):
+        g.page_views.append(stats.id)
+
+
+def page_cache(*namespaces, **options):
+    """cache the rendered page of a view for anonymous visitors.
+
+    The page is keyed on path, locale and role and folded with the generation
+    of every namespace, so content writes invalidate it.  Each namespace is a
+    format string filled with the view arguments, or a callable taking them.
+    Logged-in users, non-GET requests and pending flash messages bypass it.
+    """
+    timeout = options.get("time", PAGE_CACHE_TIME)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET" or session.get("_flashes") or \
+                    not User.get_current_user().is_anonymous():
+                return view(*args, **kwargs)
+
+            names = expand_namespaces(namespaces, kwargs)
+            key = generations.fold(PAGE_CACHE_KEY % (request.path, g.locale, "anonymous"), *names)
+
+            page = cache.get(key)
+            if page is not None:
+                body, views = page
+                if views:
+                    Stats.count_views(views)
+                response = current_app.make_response(body)
+                response.headers["X-Page-Cache"] = "hit"
+                return response
+
+            g.page_views = []
+            rv = view(*args, **kwargs)
+            if isinstance(rv, basestring):
+                cache.set(key, (rv, g.page_views), timeout)
+            return rv
+        return wrapper
+    return decorator
+
+
+############################################
+## conditional GET
+############################################
+from hashlib import md5
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(namespaces):
+    """validator of the current request, made of the generations of
+    `namespaces` and of everything else the response varies on"""
+    gens = generations.get_multi(namespaces)
+    parts = [request.path, sorted(request.args.lists()), g.locale, request.is_xhr,
+             User.get_current_user().get_id()]
+    parts.extend(gens[ns] for ns in namespaces)
+    return md5(repr(parts)).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """return a 304 response if the client copy is still valid, else None"""
+    if is_resource_modified(request.environ, etag, last_modified=last_modified):
+        return None
+    return add_validators(current_app.response_class(status=304), etag, last_modified)
+
+
+def add_validators(response, etag, last_modified=None):
+    """set ETag and Last-Modified, and ask caches to revalidate every time"""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.update(("Cookie", "Accept-Language"))
+    return response
+
+
+def conditional(*namespaces, **options):
+    """answer If-None-Match and If-Modified-Since with 304 before the view runs.
+
+    The ETag is made from the generations of `namespaces`, expanded like
+    page_cache. `last_modified` is an optional callable taking the view
+    arguments; it should be cheap, e.g. read a cached item.
+    """
+    last_modified = options.get("last_modified")
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+
+            etag = make_etag(expand_namespaces(namespaces, kwargs))
+            modified = last_modified and last_modified(kwargs)
+            response = not_modified(etag, modified)
+            if response is None:
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code == 200:
+                    add_validators(response, etag, modified)
+            return response
+        return wrapper
+    return decorator
+
+
 ############################################
 ## Users
 ############################################
@@ -63,7 +188,6 @@ def login_user(email, password, remember=False):
 ## i18n
 ############################################
 from settings import babel
-from flask import request
 from translations.config import LANGUAGES
 
 @babel.localeselector
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+# Copyright 2013 Gully Chen
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Cache prewarming after deploys and cold starts.
+
+usage: python warmup.py [--base-url http://example.com/] [--budget 20] [--workers 4]
+
+The command line fills the caches of its own process, so it only warms the
+site when the caches are shared: the local runtime needs a CACHE_BACKEND
+other than "local".  GAE runs warmup_caches from /_ah/warmup instead.
+"""
+
+import threading
+from time import time as sys_time
+from Queue import Queue, Empty
+
+from settings import app, logging
+from settings import WARMUP_TIME_BUDGET, WARMUP_WORKERS
+
+
+# modules imported on first use by request handlers, loaded here instead
+WARMUP_MODULES = ["markdown", "PIL.Image", "werkzeug.contrib.atom"]
+
+
+def _warmup_tasks(with_sitemap=True):
+    import ajax
+    import apis
+
+    tasks = [("templates", _compile_templates, ()),
+             ("modules", _import_modules, ())]
+
+    for category in apis.get_site_snapshot().categories:
+        tasks.append(("category:%s" % category.url, _fill_category,
+                      (category.url, category.posts_per_page)))
+
+    tasks.extend([
+        ("posts/hot", ajax.get_hot_posts, ()),
+        ("posts/latest", ajax.get_latest_posts, ()),
+        ("tags/hot", ajax.get_hot_tags, ()),
+        ("photos/hot", ajax.get_hot_photos, ()),
+    ])
+    if with_sitemap:
+        tasks.append(("sitemap", ajax.get_sitemap, ()))
+    return tasks
+
+
+def _compile_templates():
+    env = app.jinja_env
+    for name in env.list_templates():
+        env.get_template(name)
+
+
+def _import_modules():
+    for name in WARMUP_MODULES:
+        try:
+            __import__(name)
+        except ImportError:
+            logging.warning("warmup: no module %s" % name)
+
+
+def _fill_category(url, per_page):
+    from ajax import get_posts_by_category, CATEGORY_CACHE_PAGES
+
+    start_cursor = ""
+    for page in range(1, CATEGORY_CACHE_PAGES + 1):
+        res = get_posts_by_category(url, page, per_page, start_cursor=start_cursor)
+        if res["pager"]["is_last_page"]:
+            break
+        start_cursor = res["pager"]["start_cursor"]
+
+
+def warmup_caches(base_url=None, time_budget=WARMUP_TIME_BUDGET, workers=WARMUP_WORKERS):
+    """ bootstrap the database, then fill the caches of every category,
+    the hot/latest lists, hot tags and photos, the sitemap and the jinja templates,
+    and import the modules that request handlers load lazily.
+
+    Tasks run on at most `workers` threads, each in a request context for
+    an anonymous visitor.  Tasks not started within `time_budget` seconds
+    are skipped.  The sitemap holds absolute urls, so it is only warmed
+    when `base_url` is given.
+    """
+    from model import ensure_database
+
+    start = sys_time()
+    deadline = start + time_budget
+    report = {"done": [], "skipped": [], "errors": []}
+
+    with app.app_context():
+        ensure_database(app)
+    report["bootstrap"] = ensure_database.elapsed
+
+    with app.test_request_context(base_url=base_url):
+        tasks = _warmup_tasks(with_sitemap=base_url is not None)
+
+    queue = Queue()
+    for task in tasks:
+        queue.put(task)
+
+    def worker():
+        while True:
+            try:
+                name, func, args = queue.get_nowait()
+            except Empty:
+                return
+
+            if sys_time() > deadline:
+                report["skipped"].append(name)
+                continue
+
+            try:
+                with app.test_request_context(base_url=base_url):
+                    func(*args)
+                report["done"].append(name)
+            except Exception, e:
+                logging.exception("warmup %s error" % name)
+                report["errors"].append({"task": name, "error": unicode(e)})
+
+    threads = [threading.Thread(target=worker) for _ in range(max(workers, 1))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report["elapsed"] = sys_time() - start
+    return report
+
+
+def main():
+    import argparse
+    from flask import json
+
+    parser = argparse.ArgumentParser(description="prewarm ME@deepgully caches")
+    parser.add_argument("--base-url", default=None, help="site url, required to warm the sitemap")
+    parser.add_argument("--budget", type=float, default=WARMUP_TIME_BUDGET, help="time budget in seconds")
+    parser.add_argument("--workers", type=int, default=WARMUP_WORKERS, help="concurrent tasks")
+    options = parser.parse_args()
+
+    from settings import RUNTIME_ENV, CACHE_BACKEND
+    if RUNTIME_ENV == "local" and CACHE_BACKEND == "local":
+        parser.error('CACHE_BACKEND "local" is private to each process, there is nothing to warm')
+
+    import index  # register the views and bind the database models
+
+    report = warmup_caches(options.base_url, options.budget, options.workers)
+    print json.dumps(report, indent=2)
+
+
+if __name__ == '__main__':
+    main()